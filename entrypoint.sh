@@ -10,6 +10,19 @@ source /usr/src/app/venv/bin/activate || {
     exit 1
 }
 
+# Batch mode: register a whole split (or CSV manifest) with a single network load
+# e.g. ./entrypoint.sh batch --data_path input/Release_06_12_23 --phase test
+if [[ "$1" == "batch" ]]; then
+    shift
+    exec python scripts/register_batch.py "$@"
+fi
+
+# Service mode: keep the network warm and accept registration jobs over HTTP (port 5000)
+if [[ "$1" == "serve" ]]; then
+    shift
+    exec python scripts/server.py "$@"
+fi
+
 echo "Pozdravljen! Prosim podaj poti do slik za poravnavo."
 
 # Prompt for input interactively
@@ -76,22 +89,11 @@ if [[ "$RESPONSE" =~ ^[Yy]$ ]] || [[ -z "$RESPONSE" ]]; then
         echo "Error: Data transformation failed." >&2
         exit 1
     }
-    echo "Data transformation to .nii.gz completed."
+    echo "Data transformation to .nii.gz completed (output/reshaped_validation)."
 else
     echo "Data transformation to .nii.gz skipped."
 fi
 
-# Data reshaping prompt
-read -p "Do you want to reshape the transformation for validation method? (Y/n) " RESPONSE
-if [[ "$RESPONSE" =~ ^[Yy]$ ]] || [[ -z "$RESPONSE" ]]; then
-    python scripts/data_reshape_2.py || {
-        echo "Error: Data reshape failed." >&2
-        exit 1
-    }
-    echo "Data reshape completed."
-else
-    echo "Data reshape skipped."
-fi
 echo "All processes completed successfully!"
 exit 0
 
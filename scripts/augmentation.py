@@ -0,0 +1,86 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, get_worker_info
+
+def random_affine(batch_size, device="cpu", generator=None, noise_scale=0.05):
+    """
+    Generate random axis permutation/flip matrices with additive noise for a whole batch.
+
+    Returns a (batch_size, 3, 4) tensor of affine matrices for F.affine_grid.
+    """
+    # A random permutation per batch element, built from the argsort of uniform noise
+    perm = torch.argsort(torch.rand((batch_size, 3), device=device, generator=generator), dim=1)
+    signs = torch.randint(0, 2, (batch_size, 3, 1), device=device, generator=generator) * 2 - 1
+    identity = F.one_hot(perm, num_classes=3).float() * signs
+    identity = torch.cat([identity, torch.zeros((batch_size, 3, 1), device=device)], dim=2)
+
+    noise = torch.randn((batch_size, 3, 4), device=device, generator=generator)
+    return identity + noise_scale * noise
+
+def warp(images, forward):
+    """
+    Warp a list of (N, C, D, H, W) images with one affine grid.
+
+    The first channel of each image is an intensity image and is warped trilinearly;
+    any further channels are segmentations and are warped with nearest-neighbour
+    interpolation. All images share one grid_sample call per interpolation mode.
+    """
+    grid_shape = list(images[0].shape)
+    grid_shape[1] = 3
+    forward_grid = F.affine_grid(forward, grid_shape, align_corners=False)
+
+    intensity = torch.cat([image[:, :1] for image in images], dim=1)
+    warped_intensity = F.grid_sample(intensity, forward_grid, padding_mode="border", align_corners=False)
+
+    labels = [image[:, 1:] for image in images]
+    if any(label.shape[1] > 0 for label in labels):
+        warped_labels = F.grid_sample(
+            torch.cat(labels, dim=1), forward_grid, mode="nearest", padding_mode="border", align_corners=False
+        )
+        warped_labels = torch.split(warped_labels, [label.shape[1] for label in labels], dim=1)
+    else:
+        warped_labels = labels
+
+    return [
+        torch.cat([warped_intensity[:, i : i + 1], warped_label], dim=1)
+        for i, warped_label in enumerate(warped_labels)
+    ]
+
+def augment(image_A, image_B, generator=None):
+    """
+    Apply the same random permutation/flip + noise affine to both images of each pair.
+    """
+    forward = random_affine(image_A.shape[0], device=image_A.device, generator=generator)
+    warped_A, warped_B = warp([image_A, image_B], forward)
+    return warped_A, warped_B
+
+class AugmentedDataset(Dataset):
+    """
+    Wrap a paired dataset and apply augment() to every sample inside the DataLoader workers.
+
+    Each worker draws from its own generator seeded with torch.initial_seed(), which the
+    DataLoader sets to a per-epoch base seed plus the worker id. Calling torch.manual_seed
+    before building the DataLoader therefore makes the augmentation reproducible.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.generator = None
+        self.worker_id = None
+
+    def get_generator(self, device):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else None
+        if self.generator is None or self.worker_id != worker_id:
+            self.generator = torch.Generator(device=device).manual_seed(torch.initial_seed())
+            self.worker_id = worker_id
+        return self.generator
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        moving_img, fixed_img = self.dataset[idx]
+        generator = self.get_generator(moving_img.device)
+        with torch.no_grad():
+            moving_img, fixed_img = augment(moving_img[None], fixed_img[None], generator=generator)
+        return moving_img[0], fixed_img[0]
@@ -0,0 +1,121 @@
+import json
+import os
+import random
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Training checkpoints written by CheckpointManager:
+#   {directory}/{name}_epoch_{epoch:05d}.trch  with the network, optimizer (and grad scaler) states,
+#                                               epoch, iteration, validation loss and RNG states
+#   {directory}/{name}_index.json               epoch and validation loss of every kept checkpoint
+
+def to_cpu(state):
+    """Copy of a (nested) state dict with every tensor cloned to CPU memory."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+def rng_state():
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def load_checkpoint(path):
+    # RNG states hold numpy and python objects, so this is not a weights-only load
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+def atomic_save(obj, path):
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class CheckpointManager:
+    """
+    Save training checkpoints without stalling the training loop.
+
+    save() copies the state to CPU memory and writes it on a background thread to a temporary
+    file that is renamed into place, so a crash never leaves a partial checkpoint. Only the
+    last keep_last checkpoints and the keep_best with the lowest validation loss are kept.
+    """
+
+    def __init__(self, directory, name="checkpoint", keep_last=3, keep_best=3):
+        self.directory = Path(directory)
+        self.name = name
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / f"{name}_index.json"
+        self.index = json.loads(self.index_path.read_text()) if self.index_path.exists() else []
+        self._thread = None
+        self._error = None
+
+    def path(self, epoch):
+        return self.directory / f"{self.name}_epoch_{epoch:05d}.trch"
+
+    def save(self, state, epoch, iteration, val_loss=None):
+        """Snapshot state (network, optimizer, ...) and write it with its epoch, iteration and loss."""
+        snapshot = to_cpu(state)
+        snapshot.update(name=self.name, epoch=epoch, iteration=iteration, val_loss=val_loss)
+        # At most one write in flight, so snapshots never pile up in memory
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(snapshot,), daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        """Wait for the pending write; re-raise its error if it failed."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, snapshot):
+        try:
+            path = self.path(snapshot["epoch"])
+            atomic_save(snapshot, path)
+            self.index = [entry for entry in self.index if entry["epoch"] != snapshot["epoch"]]
+            self.index.append({"epoch": snapshot["epoch"], "val_loss": snapshot["val_loss"], "file": path.name})
+            self._apply_retention()
+        except Exception as error:
+            self._error = error
+
+    def _apply_retention(self):
+        by_epoch = sorted(self.index, key=lambda entry: entry["epoch"])
+        scored = [entry for entry in self.index if entry["val_loss"] is not None]
+        keep = by_epoch[-self.keep_last:] if self.keep_last > 0 else []
+        keep += sorted(scored, key=lambda entry: entry["val_loss"])[:self.keep_best]
+        kept_files = {entry["file"] for entry in keep}
+
+        for entry in self.index:
+            if entry["file"] not in kept_files:
+                (self.directory / entry["file"]).unlink(missing_ok=True)
+        self.index = [entry for entry in by_epoch if entry["file"] in kept_files]
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.{os.getpid()}")
+        tmp_path.write_text(json.dumps(self.index, indent=2))
+        os.replace(tmp_path, self.index_path)
+
+    def latest(self):
+        """Path of the most recent checkpoint, or None."""
+        return self.directory / self.index[-1]["file"] if self.index else None
+
+    def best(self):
+        """Path of the checkpoint with the lowest validation loss, or None."""
+        scored = [entry for entry in self.index if entry["val_loss"] is not None]
+        return self.directory / min(scored, key=lambda entry: entry["val_loss"])["file"] if scored else None
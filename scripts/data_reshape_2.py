@@ -24,8 +24,8 @@ for file_path in file_paths:
         print(f"\nProcessing file: {file_path}")
         print(f"Shape of the above NIfTI file: {data_shape}")
         
-        # Get the data array
-        data = nii_img.get_fdata()
+        # Get the data array in its stored dtype (get_fdata would upcast the whole field to float64)
+        data = np.asanyarray(nii_img.dataobj)
 
         # Check and fix the shape if necessary
         if len(data_shape) == 5 and data_shape[3] == 1:  # Check for extra dimension
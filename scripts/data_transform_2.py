@@ -1,60 +1,112 @@
-import h5py
-import SimpleITK as sitk
+import argparse
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-# Set the root path
-root_path = "output"
-root_dir = Path(root_path)
-
-# Create output directory if it doesn't exist
-output_dir = root_dir / "reshaped"
-output_dir.mkdir(exist_ok=True)
-
-# Reference size, origin, spacing, and direction
-size = [256, 192, 192]  # Correct size for the displacement field
-spacing = [1.0, 1.0, 1.0]  # Adjust spacing as needed (e.g., real-world units)
-origin = [0.0, 0.0, 0.0]  # Set to align with the domain
-direction = [1.0, 0.0, 0.0,  # Identity direction matrix (modify if needed)
-             0.0, 1.0, 0.0,
-             0.0, 0.0, 1.0]
-
-# Process each HDF5 file
-for file_path in root_dir.glob("*.hdf5"):
-    try:
-        print(f"Processing file: {file_path}")
-
-        # Load the transform from the HDF5 file
-        transform = sitk.ReadTransform(str(file_path))  # Convert Path to string for compatibility
-
-        # Convert the transform to a displacement field (image)
-        displacement_field = sitk.TransformToDisplacementField(
-            transform,
-            sitk.sitkVectorFloat64,  # Ensures 3D vector type
-            size,
-            origin,
-            spacing,
-            direction
-        )
-
-        # Print the size of the created displacement field
-        print(f"Displacement field size: {displacement_field.GetSize()}")
-        print(f"Number of components per pixel: {displacement_field.GetNumberOfComponentsPerPixel()}")
-        array_x = sitk.GetArrayFromImage(displacement_field)
-        print(f"Displacement field array shape: {array_x.shape}")
-
-        # Validate displacement field
-        if displacement_field.GetSize() != tuple(size):
-            raise ValueError(f"Displacement field has wrong size: {displacement_field.GetSize()}")
-
-        if displacement_field.GetNumberOfComponentsPerPixel() != 3:
-            raise ValueError("Displacement field must have 3 components per pixel.")
-
-        # Save the displacement field as a NIfTI image
-        output_file = output_dir / f"{file_path.stem}.nii.gz"
-        sitk.WriteImage(displacement_field, str(output_file), useCompression=True)
-        print(f"Saved displacement field: {output_file}")
-
-    except FileNotFoundError:
-        print(f"\nError: File not found at '{file_path}'. Please check the path and try again.")
-    except Exception as e:
-        print(f"\nError processing '{file_path}': {e}")
\ No newline at end of file
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+# python scripts/data_transform_2.py --input_dir output --images_dir input/Release_06_12_23/imagesTr input/Release_06_12_23/imagesTs
+
+def read_grid(image_path):
+    """Read size, origin, spacing and direction of an image from its header, without decoding voxels."""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(image_path))
+    reader.ReadImageInformation()
+    return reader.GetSize(), reader.GetOrigin(), reader.GetSpacing(), reader.GetDirection()
+
+def find_fixed_image(transform_path, images_dirs):
+    """Fixed image of disp_{fixed}_{moving}.hdf5, e.g. ThoraxCBCT_0011_0001.nii.gz for disp_0011_0001_0011_0000."""
+    if isinstance(images_dirs, (str, Path)):
+        images_dirs = [images_dirs]
+    parts = Path(transform_path).name.split(".")[0].split("_")
+    fixed_id = "_".join(parts[1:3])
+    for images_dir in images_dirs:
+        matches = sorted(Path(images_dir).glob(f"*_{fixed_id}.nii*"))
+        if matches:
+            return matches[0]
+    raise FileNotFoundError(f"No fixed image for case {fixed_id} in {', '.join(map(str, images_dirs))}")
+
+def grid_affine(origin, spacing, direction):
+    """NIfTI (RAS) affine of an ITK (LPS) image grid."""
+    affine = np.eye(4)
+    affine[:3, :3] = np.reshape(direction, (3, 3)) * spacing
+    affine[:3, 3] = origin
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+def export_displacement(transform, fixed_path, output_path, compression_level=1):
+    """
+    Write the final validation field disp_*.nii.gz of an in-memory SimpleITK transform.
+
+    The field is sampled as float32 on the fixed image grid and streamed through gzip at the
+    given level (0-9) in its final (x, y, z, 3) layout. SimpleITK would write vector images
+    as 5D NIfTI and ignores the gzip level, so the file is written with nibabel from a
+    transposed view of the field buffer, without intermediate files or float64 copies.
+    """
+    size, origin, spacing, direction = read_grid(fixed_path)
+    field = sitk.TransformToDisplacementField(transform, sitk.sitkVectorFloat32, size, origin, spacing, direction)
+    array = sitk.GetArrayViewFromImage(field).transpose(2, 1, 0, 3)  # (z, y, x, 3) -> (x, y, z, 3)
+
+    affine = grid_affine(origin, spacing, direction)
+    image = nib.Nifti1Image(array, affine)
+    image.set_qform(affine, code=1)
+    image.set_sform(affine, code=1)
+    image.header.set_xyzt_units("mm")
+    with gzip.open(output_path, "wb", compresslevel=compression_level) as f:
+        image.to_file_map({"image": nib.FileHolder(fileobj=f)})
+    return output_path
+
+def convert_file(transform_path, fixed_path, output_path, compression_level=1):
+    """Convert one HDF5 transform to a float32 displacement field on the fixed image grid."""
+    transform = sitk.ReadTransform(str(transform_path))
+    return export_displacement(transform, fixed_path, output_path, compression_level)
+
+def is_up_to_date(input_path, output_path):
+    return output_path.exists() and output_path.stat().st_mtime >= input_path.stat().st_mtime
+
+def init_worker(threads):
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(threads)
+
+def convert_all(input_dir, images_dirs, output_dir, workers=None, force=False, compression_level=1):
+    """Convert every *.hdf5 transform in input_dir in a process pool, skipping files that fail."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    jobs = []
+    for transform_path in sorted(Path(input_dir).glob("*.hdf5")):
+        output_path = output_dir / f"{transform_path.stem}.nii.gz"
+        if not force and is_up_to_date(transform_path, output_path):
+            print(f"Up to date: {output_path}")
+            continue
+        try:
+            fixed_path = find_fixed_image(transform_path, images_dirs)
+        except Exception as e:
+            print(f"\nError processing '{transform_path}': {e}")
+            continue
+        jobs.append((transform_path, fixed_path, output_path))
+
+    workers = workers or os.cpu_count()
+    threads = max(1, os.cpu_count() // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads,)) as executor:
+        futures = {executor.submit(convert_file, *job, compression_level): job[0] for job in jobs}
+        for future, transform_path in futures.items():
+            try:
+                print(f"Saved displacement field: {future.result()}")
+            except Exception as e:
+                print(f"\nError processing '{transform_path}': {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert HDF5 transforms to displacement fields on the fixed image grid.")
+    parser.add_argument("--input_dir", default="output", help="Directory with disp_{fixed}_{moving}.hdf5 transforms.")
+    parser.add_argument("--images_dir", nargs="+",
+                        default=["input/Release_06_12_23/imagesTr", "input/Release_06_12_23/imagesTs"],
+                        help="Directories searched in order for the fixed images.")
+    parser.add_argument("--output_dir", default="output/reshaped_validation", help="Directory for the .nii.gz fields.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("--force", action="store_true", help="Convert even if the output is newer than the input.")
+    parser.add_argument("--compression_level", type=int, default=1, help="Gzip level of the written fields (0-9).")
+    args = parser.parse_args()
+
+    convert_all(args.input_dir, args.images_dir, args.output_dir, args.workers, args.force, args.compression_level)
@@ -1,12 +1,17 @@
 import torch
 import os
 import itk
+import hashlib
+import numpy as np
 from torch.utils.data import Dataset
 import json
 from tqdm import tqdm
 
+CLAMP_WINDOW = (-1000, 1000)
+
 class ThoraxCBCTDataset(Dataset):
-    def __init__(self, data_path, phase="train", paired=True, data_num=-1, desired_shape=None, device="cpu"):
+    def __init__(self, data_path, phase="train", paired=True, data_num=-1, desired_shape=None, device="cpu", cache_dir=None,
+                 preload=False, preload_dtype=torch.float16):
         """
         Initialize the ThoraxCBCTDataset.
 
@@ -17,9 +22,15 @@ class ThoraxCBCTDataset(Dataset):
             data_num (int): Limit on the number of samples to load (-1 for all).
             desired_shape (tuple): Desired shape for resizing images.
             device (str): Device to use ('cpu' or 'cuda').
+            cache_dir (str): Directory for preprocessed volumes (None disables caching).
+            preload (bool): If True, decode all unique volumes once into shared memory.
+            preload_dtype (torch.dtype): Storage type of the preloaded volumes.
         """
         self.device = device
         self.desired_shape = desired_shape
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
 
         # Load dataset metadata
         with open(os.path.join(data_path, "ThoraxCBCT_dataset.json"), "r") as f:
@@ -43,16 +54,81 @@ class ThoraxCBCTDataset(Dataset):
             for pair in data_list
         ]
 
-    def load_image(self, img_path):
+        self.volumes = None
+        if preload:
+            self.preload_images(preload_dtype)
+
+    def preload_images(self, dtype):
         """
-        Load and preprocess a single image.
+        Decode every unique volume once and store all of them in a single shared-memory block.
+
+        Fixed images appear in many training pairs, so volumes are deduplicated by path.
+        DataLoader workers index the shared block without copying it.
+        """
+        if not self.desired_shape:
+            raise ValueError("Preloading requires desired_shape so that all volumes have the same size.")
+
+        unique_paths = sorted({path for pair in self.img_pairs for path in pair})
+        self.volume_index = {path: i for i, path in enumerate(unique_paths)}
+        self.volumes = torch.empty((len(unique_paths), 1, *self.desired_shape), dtype=dtype).share_memory_()
+        for i, path in enumerate(tqdm(unique_paths, desc="Preloading volumes")):
+            self.volumes[i] = self.read_image(path)
+
+    def preprocess_image(self, img_path):
+        """
+        Read, normalize and resize a single image.
         """
         img = torch.tensor(itk.GetArrayFromImage(itk.imread(img_path))).float()
-        img = (torch.clamp(img, -1000, 1000) + 1000) / 2000  # Normalize to [0, 1]
+        low, high = CLAMP_WINDOW
+        img = (torch.clamp(img, low, high) - low) / (high - low)  # Normalize to [0, 1]
         if self.desired_shape:
             img = torch.nn.functional.interpolate(
                 img[None, None, ...], size=self.desired_shape, mode="trilinear", align_corners=False
             ).squeeze(0)
+        return img
+
+    def cache_path(self, img_path):
+        """
+        Cache file for an image, keyed by source path, mtime, clamp window and shape.
+        """
+        img_path = os.path.abspath(img_path)
+        key = f"{img_path}|{os.stat(img_path).st_mtime_ns}|{CLAMP_WINDOW}|{self.desired_shape and tuple(self.desired_shape)}"
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        name = os.path.basename(img_path).split(".")[0]
+        return os.path.join(self.cache_dir, f"{name}_{digest}.npy")
+
+    def load_cached_image(self, img_path):
+        """
+        Serve a preprocessed image from the cache, building the entry on a miss. The returned
+        tensor is backed by a memory map of the cache file.
+        """
+        cache_file = self.cache_path(img_path)
+        if not os.path.exists(cache_file):
+            img = self.preprocess_image(img_path).numpy()
+            # Write to a temporary file first so concurrent workers never see a partial entry
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as f:
+                np.save(f, img)
+            os.replace(tmp_file, cache_file)
+        # Copy-on-write memory map: pages are read lazily and shared through the page cache
+        return torch.from_numpy(np.load(cache_file, mmap_mode="c"))
+
+    def read_image(self, img_path):
+        """
+        Read a preprocessed image on the CPU, from the cache if enabled.
+        """
+        if self.cache_dir:
+            return self.load_cached_image(img_path)
+        return self.preprocess_image(img_path)
+
+    def load_image(self, img_path):
+        """
+        Load and preprocess a single image.
+        """
+        if self.volumes is not None:
+            img = self.volumes[self.volume_index[img_path]].float()
+        else:
+            img = self.read_image(img_path)
         return img.to(self.device)
 
     def __len__(self):
@@ -0,0 +1,115 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import SimpleITK as sitk
+
+from oncoreg import case_id, find_pair_annotations, load_pairs, pair_name
+from post_process import compute_metrics, load_case, load_csv, save_results
+
+# python scripts/evaluate_batch.py --data_path input/Release_06_12_23 --results_dir output --phase val
+
+def discover_cases(data_path, results_dir, phase):
+    """Collect every pair of a split with its registration outputs and annotations."""
+    cases = []
+    for pair in load_pairs(data_path, phase):
+        name = pair_name(pair["fixed"], pair["moving"])
+        case = {
+            "name": f"{case_id(pair['fixed'])}<--{case_id(pair['moving'])}",
+            "fixed": pair["fixed"],
+            "warped": os.path.join(results_dir, f"warped_{name}.nii.gz"),
+            "transform_file": os.path.join(results_dir, f"disp_{name}.hdf5"),
+            "disp_file": os.path.join(results_dir, "reshaped_validation", f"disp_{name}.nii.gz"),
+        }
+        if not os.path.exists(case["disp_file"]):
+            case["disp_file"] = None
+        for kind, prefix in (("keypoints", "kp"), ("landmarks", "lm")):
+            case[f"{prefix}_fixed"], case[f"{prefix}_moving"] = find_pair_annotations(pair["fixed"], pair["moving"], kind)
+
+        if not (os.path.exists(case["warped"]) and os.path.exists(case["transform_file"])):
+            print(f"Skipping {case['name']}: registration outputs not found.")
+            continue
+        cases.append(case)
+    return cases
+
+def init_worker():
+    # One ITK thread per process, the pool already uses every core
+    sitk.ProcessObject_SetGlobalDefaultNumberOfThreads(1)
+
+def evaluate_case(case):
+    """Evaluate one case in a worker process."""
+    fixed_np, warped_np, spacing = load_case(case["fixed"], case["warped"])
+    results = compute_metrics(
+        fixed_np, warped_np, case["transform_file"], spacing=spacing,
+        kp_fixed=load_csv(case["kp_fixed"]), kp_moving=load_csv(case["kp_moving"]),
+        lm_fixed=load_csv(case["lm_fixed"]), lm_moving=load_csv(case["lm_moving"]),
+        disp_file=case["disp_file"],
+    )
+    return case["name"], {key: float(value) if value != "N/A" else value for key, value in results.items()}
+
+def aggregate(case_results):
+    """
+    Mean, standard deviation and 30th percentile of every metric over all cases. Non-finite
+    values (e.g. an infinite HD95 of an empty surface) are left out and counted in non_finite.
+    """
+    aggregates = {}
+    metrics = {key for results in case_results.values() for key in results}
+    for metric in sorted(metrics):
+        values = np.array([
+            results[metric] for results in case_results.values()
+            if results.get(metric, "N/A") != "N/A"
+        ], dtype=np.float64)
+        finite = values[np.isfinite(values)]
+        if len(finite) == 0:
+            continue
+        aggregates[metric] = {
+            "mean": float(finite.mean()),
+            "std": float(finite.std()),
+            "30": float(np.percentile(finite, 30)),
+            "non_finite": int(len(values) - len(finite)),
+        }
+    return aggregates
+
+def evaluate_batch(data_path, results_dir, phase="val", workers=None, output_dir="outputs"):
+    cases = discover_cases(data_path, results_dir, phase)
+    print(f"Evaluating {len(cases)} cases from the '{phase}' split.")
+
+    case_results, failed = {}, {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(evaluate_case, case): case["name"] for case in cases}
+        for future in as_completed(futures):
+            try:
+                name, results = future.result()
+            except Exception as e:
+                failed[futures[future]] = str(e)
+                print(f"\nError evaluating '{futures[future]}': {e}")
+                continue
+            case_results[name] = results
+            print(f"Finished {name}")
+
+    # Aggregate over the cases that succeeded, keeping the input order
+    case_results = {case["name"]: case_results[case["name"]] for case in cases if case["name"] in case_results}
+    aggregated = {"aggregates": aggregate(case_results), "cases": case_results}
+    if failed:
+        print(f"\n{len(failed)} of {len(cases)} cases failed and are not aggregated.")
+        aggregated["failed"] = failed
+
+    print("\nAggregated Results:")
+    for key, value in aggregated["aggregates"].items():
+        non_finite = f"  ({value['non_finite']} non-finite left out)" if value["non_finite"] else ""
+        print(f"{key:<22}: mean {value['mean']:.5f}  std {value['std']:.5f}  30% {value['30']:.5f}{non_finite}")
+
+    save_results(aggregated, output_dir=output_dir, prefix="aggregated_results")
+    return aggregated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate registration metrics over a whole OncoReg split.")
+    parser.add_argument("--data_path", required=True, help="Dataset directory containing ThoraxCBCT_dataset.json.")
+    parser.add_argument("--results_dir", default="output", help="Directory with warped_*.nii.gz and disp_*.hdf5 outputs.")
+    parser.add_argument("--phase", default="val", choices=["val", "test"], help="Dataset split to evaluate.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: all cores).")
+    parser.add_argument("--output_dir", default="outputs", help="Directory for the aggregated results file.")
+    args = parser.parse_args()
+
+    evaluate_batch(args.data_path, args.results_dir, args.phase, args.workers, args.output_dir)
@@ -0,0 +1,106 @@
+import copy
+import hashlib
+import os
+import weakref
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from icon_registration import config
+from icon_registration.itk_wrapper import DEFAULT_FINETUNE_LEARNING_RATE, create_itk_transform
+
+# Warm-start cache of instance optimization (IO) states, one directory per
+# (images, modalities, network weights, similarity, learning rate) key:
+#   {cache_dir}/{key}/step_{n}.trch  with the network and Adam states after n IO iterations.
+# A state holds the weights and both Adam moments (~0.85 GB for uniGradICON), so by
+# default only the last state of every run is kept.
+
+_weights_digests = weakref.WeakKeyDictionary()
+
+def weights_digest(net):
+    """SHA-1 of the network weights, computed once per network instance."""
+    if net not in _weights_digests:
+        digest = hashlib.sha1()
+        for name, tensor in sorted(net.state_dict().items()):
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        _weights_digests[net] = digest.hexdigest()
+    return _weights_digests[net]
+
+def array_digest(array):
+    digest = hashlib.sha1(str((array.shape, array.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+def cache_key(net, moving_array, fixed_array, moving_modality, fixed_modality, io_sim, learning_rate):
+    """Content address of the IO states of one pair."""
+    parts = [
+        array_digest(moving_array), array_digest(fixed_array),
+        moving_modality, fixed_modality, weights_digest(net), io_sim, repr(learning_rate),
+    ]
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+def cached_steps(state_dir):
+    """IO iteration counts with a cached state in state_dir."""
+    return sorted(int(path.stem.split("_")[1]) for path in Path(state_dir).glob("step_*.trch"))
+
+def save_state(state_dir, step, net, optimizer):
+    path = Path(state_dir) / f"step_{step}.trch"
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+    torch.save({"model": net.state_dict(), "optimizer": optimizer.state_dict()}, tmp_path)
+    os.replace(tmp_path, path)
+
+def finetune_cached(net, image_A, image_B, steps, state_dir, learning_rate=DEFAULT_FINETUNE_LEARNING_RATE,
+                    save_every=None):
+    """
+    Instance optimization as in icon_registration's finetune_execute (Adam, steps iterations),
+    resumed from the largest cached step <= steps and saving the state after the last step
+    (and every save_every steps). The network is left in its optimized state.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    optimizer = torch.optim.Adam(net.parameters(), lr=learning_rate)
+
+    start = max((step for step in cached_steps(state_dir) if step <= steps), default=0)
+    if start:
+        state = torch.load(Path(state_dir) / f"step_{start}.trch", map_location=config.device)
+        net.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        print(f"Resuming IO from cached step {start}/{steps}")
+
+    for step in range(start + 1, steps + 1):
+        optimizer.zero_grad()
+        loss_tuple = net(image_A, image_B)
+        loss_tuple[0].backward()
+        optimizer.step()
+        if step == steps or (save_every and step % save_every == 0):
+            save_state(state_dir, step, net, optimizer)
+
+    with torch.no_grad():
+        return net(image_A, image_B)
+
+def register_pair_cached(net, image_A, image_B, steps, cache_dir, io_sim, modality_A="ct", modality_B="ct",
+                         learning_rate=DEFAULT_FINETUNE_LEARNING_RATE, save_every=None):
+    """
+    Equivalent of icon_registration.itk_wrapper.register_pair(net, image_A, image_B, steps)
+    for the A -> B (moving -> fixed) transform, with IO states cached under cache_dir.
+    """
+    net.to(config.device)
+    A_npy = np.array(image_A)
+    B_npy = np.array(image_B)
+    state_dir = Path(cache_dir) / cache_key(net, A_npy, B_npy, modality_A, modality_B, io_sim, learning_rate)
+
+    # Resize the images to the network input shape, as register_pair does
+    shape = net.identity_map.shape
+    A_resized = F.interpolate(torch.Tensor(A_npy).to(config.device)[None, None], size=shape[2:], mode="trilinear", align_corners=False)
+    B_resized = F.interpolate(torch.Tensor(B_npy).to(config.device)[None, None], size=shape[2:], mode="trilinear", align_corners=False)
+
+    state_dict = copy.deepcopy(net.state_dict())
+    try:
+        finetune_cached(net, A_resized, B_resized, steps, state_dir, learning_rate, save_every)
+        with torch.no_grad():
+            phi_AB = net.phi_AB(net.identity_map)
+    finally:
+        net.load_state_dict(state_dict)
+    return create_itk_transform(phi_AB, net.identity_map, image_A, image_B)
@@ -0,0 +1,132 @@
+import argparse
+import os
+
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+from data_transform_2 import read_grid
+from similarity import slabs
+from transforms import read_transform_chain
+
+# python scripts/jacobian.py output/reshaped_validation/disp_0011_0001_0011_0000.nii.gz
+# python scripts/jacobian.py output/disp_0011_0001_0011_0000.hdf5 --fixed input/Release_06_12_23/imagesTr/ThoraxCBCT_0011_0001.nii.gz
+
+def read_nifti_field(field_path):
+    """Read a disp_*.nii.gz field ((x, y, z, 3) in mm) as a (3, z, y, x) view with its LPS grid geometry."""
+    image = nib.load(field_path)
+    data = np.asanyarray(image.dataobj)
+    field = data.reshape(*data.shape[:3], 3).transpose(3, 2, 1, 0)
+
+    # NIfTI affines are RAS, the field and ITK geometry are LPS
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ image.affine
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    return field, affine[:3, 3], spacing, affine[:3, :3] / spacing
+
+def read_field(field_path, fixed_path=None):
+    """
+    Displacement field as ((3, z, y, x) array, origin, spacing, direction).
+
+    Reads the exported disp_*.nii.gz, or an HDF5 transform directly. An HDF5 file holding a
+    single displacement field is used as stored; any other transform (or any transform when
+    fixed_path is given) is sampled on the fixed image grid, or on the grid of its first field.
+    """
+    if field_path.endswith((".nii", ".nii.gz")):
+        return read_nifti_field(field_path)
+
+    chain = read_transform_chain(field_path)
+    if fixed_path is None:
+        fields = [step for step in chain if step[0] == "field"]
+        if len(chain) == 1 and fields:
+            return fields[0][1:]
+        if not fields:
+            raise ValueError(f"{field_path} has no displacement field, pass the fixed image to define the grid")
+        field, origin, spacing, direction = fields[0][1:]
+        grid = (field.shape[:0:-1], origin, spacing, direction)
+    else:
+        grid = read_grid(fixed_path)
+
+    size, origin, spacing, direction = grid
+    displacement = sitk.TransformToDisplacementField(
+        sitk.ReadTransform(field_path), sitk.sitkVectorFloat64,
+        [int(n) for n in size], list(origin), list(spacing), list(np.ravel(direction)),
+    )
+    field = np.moveaxis(sitk.GetArrayFromImage(displacement), -1, 0)
+    return field, np.asarray(origin), np.asarray(spacing), np.reshape(direction, (3, 3))
+
+def jacobian_slabs(field, spacing, direction=None, slab_size=16):
+    """
+    Yield (start, stop, determinant) for z-slabs of a (3, z, y, x) displacement field in mm.
+
+    The Jacobian of x -> x + u(x) uses central differences (one-sided at the borders) with
+    physical spacing, rotated to physical axes by the grid direction. Each slab carries a
+    one-slice halo, so the result equals a whole-volume np.gradient.
+    """
+    sx, sy, sz = spacing
+    direction_t = np.eye(3) if direction is None else np.asarray(direction).T
+    depth = field.shape[1]
+    for start, stop, lo, hi in slabs(depth, slab_size, halo=1):
+        u = field[:, lo:hi].astype(np.float64)
+        if hi - lo > 1:
+            d_dz, d_dy, d_dx = np.gradient(u, sz, sy, sx, axis=(1, 2, 3))
+        else:
+            d_dz = np.zeros_like(u)
+            d_dy, d_dx = np.gradient(u, sy, sx, axis=(2, 3))
+        core = slice(start - lo, stop - lo)
+        # grad[..., c, a]: derivative of u_c along grid axis a (x, y, z)
+        grad = np.moveaxis(np.stack([d_dx[:, core], d_dy[:, core], d_dz[:, core]], axis=-1), 0, -2)
+        yield start, stop, np.linalg.det(grad @ direction_t + np.eye(3))
+
+def jacobian_determinant(field, spacing, direction=None, slab_size=16):
+    """Per-voxel Jacobian determinant (z, y, x) of a displacement field."""
+    determinant = np.empty(field.shape[1:], dtype=np.float32)
+    for start, stop, slab in jacobian_slabs(field, spacing, direction, slab_size):
+        determinant[start:stop] = slab
+    return determinant
+
+def jacobian_statistics(field, spacing, direction=None, slab_size=16, return_fold_mask=False):
+    """
+    Standard deviation of the log Jacobian determinant (clipped to [1e-9, 1e9]) and the
+    number of folded voxels (determinant <= 0), accumulated over z-slabs.
+    """
+    count, log_sum, log_sum_sq, folds = 0, 0.0, 0.0, 0
+    fold_mask = np.zeros(field.shape[1:], dtype=bool) if return_fold_mask else None
+    for start, stop, determinant in jacobian_slabs(field, spacing, direction, slab_size):
+        log_jac = np.log(np.clip(determinant, 1e-9, 1e9))
+        count += log_jac.size
+        log_sum += log_jac.sum()
+        log_sum_sq += (log_jac * log_jac).sum()
+        folded = determinant <= 0
+        folds += int(folded.sum())
+        if fold_mask is not None:
+            fold_mask[start:stop] = folded
+
+    mean = log_sum / count
+    results = {"LogJacDetStd": float(np.sqrt(max(log_sum_sq / count - mean ** 2, 0.0))), "num_foldings": folds}
+    return (results, fold_mask) if return_fold_mask else results
+
+def write_fold_mask(fold_mask, origin, spacing, direction, output_path):
+    image = sitk.GetImageFromArray(fold_mask.astype(np.uint8))
+    image.SetOrigin(tuple(float(v) for v in origin))
+    image.SetSpacing(tuple(float(v) for v in spacing))
+    image.SetDirection(tuple(float(v) for v in np.ravel(direction)))
+    sitk.WriteImage(image, output_path, useCompression=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Jacobian determinant statistics of displacement fields.")
+    parser.add_argument("fields", nargs="+", help="disp_*.nii.gz fields or disp_*.hdf5 transforms.")
+    parser.add_argument("--fixed", help="Fixed image whose grid the HDF5 transforms are sampled on.")
+    parser.add_argument("--fold_mask_dir", help="Directory to write folds_{name}.nii.gz masks of folded voxels.")
+    parser.add_argument("--slab_size", type=int, default=16, help="Number of z-slices processed at once.")
+    args = parser.parse_args()
+
+    if args.fold_mask_dir:
+        os.makedirs(args.fold_mask_dir, exist_ok=True)
+
+    for field_path in args.fields:
+        field, origin, spacing, direction = read_field(field_path, args.fixed)
+        results, fold_mask = jacobian_statistics(field, spacing, direction, args.slab_size, return_fold_mask=True)
+        print(f"{os.path.basename(field_path)}: LogJacDetStd {results['LogJacDetStd']:.5f}  num_foldings {results['num_foldings']}")
+        if args.fold_mask_dir:
+            name = os.path.basename(field_path).split(".")[0].replace("disp_", "", 1)
+            write_fold_mask(fold_mask, origin, spacing, direction, os.path.join(args.fold_mask_dir, f"folds_{name}.nii.gz"))
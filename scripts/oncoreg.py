@@ -0,0 +1,63 @@
+import os
+import json
+from glob import glob
+
+DATASET_JSON = "ThoraxCBCT_dataset.json"
+
+PHASE_KEYS = {
+    "train": "training_paired_images",
+    "val": "registration_val",
+    "test": "registration_test",
+}
+
+def load_pairs(data_path, phase="val"):
+    """Read the fixed/moving pairs of a dataset split as absolute paths."""
+    with open(os.path.join(data_path, DATASET_JSON), "r") as f:
+        dataset_info = json.load(f)
+
+    if phase not in PHASE_KEYS:
+        raise ValueError(f"Invalid phase. Choose from {', '.join(PHASE_KEYS)}.")
+
+    return [
+        {"fixed": os.path.join(data_path, pair["fixed"]), "moving": os.path.join(data_path, pair["moving"])}
+        for pair in dataset_info[PHASE_KEYS[phase]]
+    ]
+
+def case_id(image_path):
+    """Case id of an image, e.g. 0011_0001 for imagesTr/ThoraxCBCT_0011_0001.nii.gz."""
+    name = os.path.basename(image_path).split(".")[0]
+    return name.split("_", 1)[1] if "_" in name else name
+
+def pair_name(fixed_path, moving_path):
+    """Pair name used by the validation container, e.g. 0011_0001_0011_0000."""
+    return f"{case_id(fixed_path)}_{case_id(moving_path)}"
+
+def annotation_index(fixed_path, moving_path):
+    """
+    Index of the annotation folders (e.g. keypoints02Tr) of a pair: the time point of its
+    image other than _0000, e.g. 2 for 0011_0002 <-> 0011_0000. None if neither has one.
+    """
+    for image_path in (fixed_path, moving_path):
+        timepoint = case_id(image_path).rsplit("_", 1)[-1]
+        if timepoint.isdigit() and int(timepoint) != 0:
+            return int(timepoint)
+    return None
+
+def find_annotation(image_path, kind, index=None):
+    """
+    Find the keypoints or landmarks CSV of an image in a sibling folder such as keypoints01Tr.
+
+    Each folder holds the annotations of one pair, so the _0000 image has a CSV in several of
+    them; index selects the folder (kind{index:02d}*), see annotation_index. Without an index
+    the first folder with a matching CSV is used. Returns None when no such file exists.
+    """
+    image_dir = os.path.dirname(image_path)
+    name = os.path.basename(image_path).split(".")[0]
+    folder = f"{kind}*" if index is None else f"{kind}{index:02d}*"
+    candidates = sorted(glob(os.path.join(os.path.dirname(image_dir), folder, f"{name}.csv")))
+    return candidates[0] if candidates else None
+
+def find_pair_annotations(fixed_path, moving_path, kind):
+    """Fixed and moving keypoints or landmarks CSVs of a pair, both from the pair's own folder."""
+    index = annotation_index(fixed_path, moving_path)
+    return find_annotation(fixed_path, kind, index), find_annotation(moving_path, kind, index)
@@ -0,0 +1,69 @@
+import queue
+import threading
+
+_STOP = object()
+
+class StageError(Exception):
+    """Failure of one item in a pipeline stage; the item skips all later stages."""
+
+    def __init__(self, stage, error):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+def run_pipeline(items, stages, queue_size=2):
+    """
+    Run items through stages = [(name, function, workers), ...] and yield (item, result, error).
+
+    Every stage has its own pool of worker threads and a bounded input queue, so stage i + 1
+    of one item overlaps stage i of the next while at most queue_size items wait between two
+    stages (backpressure bounds memory). A stage function takes the previous stage's result
+    (the item itself for the first stage). Results are yielded in completion order; error is
+    a StageError if a stage raised, in which case result is None.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    remaining = [workers for _, _, workers in stages]
+    lock = threading.Lock()
+
+    def feed():
+        for item in items:
+            queues[0].put((item, item, None))
+        for _ in range(stages[0][2]):
+            queues[0].put(_STOP)
+
+    def work(index):
+        name, function, _ = stages[index]
+        inbox, outbox = queues[index], queues[index + 1]
+        while True:
+            task = inbox.get()
+            if task is _STOP:
+                with lock:
+                    remaining[index] -= 1
+                    last = remaining[index] == 0
+                # The last worker of a stage stops the next one
+                if last:
+                    next_workers = stages[index + 1][2] if index + 1 < len(stages) else 1
+                    for _ in range(next_workers):
+                        outbox.put(_STOP)
+                return
+            item, value, error = task
+            if error is None:
+                try:
+                    value = function(value)
+                except Exception as e:
+                    value, error = None, StageError(name, e)
+            outbox.put((item, value, error))
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for index, (_, _, workers) in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(index,), daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    while True:
+        task = queues[-1].get()
+        if task is _STOP:
+            break
+        yield task
+    for thread in threads:
+        thread.join()
@@ -1,24 +1,24 @@
 import argparse
 import os
 import numpy as np
-import nrrd
-import h5py
 import SimpleITK as sitk
 import matplotlib.pyplot as plt
-from scipy.ndimage import distance_transform_edt
-from scipy.stats import pearsonr
 import json
 from datetime import datetime
-from pathlib import Path
 import pandas as pd
+from transforms import apply_transform_chain, read_transform_chain
+from volume import Volume, mask_bounding_box, parse_roi
+from jacobian import jacobian_statistics, read_field
+from metrics import compute_hd95, compute_multilabel_metrics
+from similarity import compute_ncc, compute_similarity
 
-def save_results(results, output_dir="outputs"):
+def save_results(results, output_dir="outputs", prefix="results"):
     # Ensuring the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
     # Generating a timestamped filename
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_file = os.path.join(output_dir, f"results_{timestamp}.json")
+    output_file = os.path.join(output_dir, f"{prefix}_{timestamp}.json")
 
     # Saving the results to the .json file
     with open(output_file, "w") as f:
@@ -31,11 +31,11 @@ def load_csv(file_path):
     return None
 # python post_process.py --fixed=data/RegLib_C01_1.nrrd --warped=outputs/warped_C01_1.nrrd
 # Resample function due to size mismatch
-def resample_image(image, reference_image):
+def resample_image(image, reference_image, interpolator=sitk.sitkLinear):
     """Resample image to match the reference image using SimpleITK."""
     resampler = sitk.ResampleImageFilter()
     resampler.SetReferenceImage(reference_image)
-    resampler.SetInterpolator(sitk.sitkLinear)
+    resampler.SetInterpolator(interpolator)
     resampler.SetOutputSpacing(reference_image.GetSpacing())
     resampler.SetSize(reference_image.GetSize())
     resampler.SetOutputOrigin(reference_image.GetOrigin())
@@ -43,81 +43,15 @@ def resample_image(image, reference_image):
     return resampler.Execute(image)
 
 # Loaders for different file types
-def load_image(file_path):
-    """Load image based on file extension."""
-    ext = Path(file_path).suffixes
-
-    if ext == [".nii", ".gz"]:
-        img = sitk.ReadImage(file_path)  # Read directly as SimpleITK Image
-
-    elif ext == [".nrrd", ".nhdr"]:
-        img, _ = nrrd.read(file_path)
-        img = sitk.GetImageFromArray(img)  # Convert to SimpleITK Image
-    
-    elif ext == [".hdf5"]:
-        with h5py.File(file_path, "r") as f:
-            if "warped_image" in f:
-                img = f["warped_image"][:]
-                img = sitk.GetImageFromArray(img)  # Convert to SimpleITK Image
-            else:
-                raise ValueError("Missing 'warped_image' in HDF5 file.")
-    
-    else:
-        raise ValueError(f"Unsupported file format: {''.join(ext)}")
-    
-    return img
+def load_image(file_path, roi=None):
+    """Load an image, or only a (z, y, x) ROI of it, as a SimpleITK image (see volume.Volume)."""
+    return Volume(file_path).read_image(roi)
 
 # Applying Transformation to Keypoints
 def apply_transformation(points, transform_file):
-    with h5py.File(transform_file, "r") as f:
-        for key in f["TransformGroup"].keys():
-            transform_type = f["TransformGroup"][key]["TransformType"][()][0].decode()
-            print(f"Processing TransformType: {transform_type}")
-
-            if transform_type == "CenteredAffineTransform_double_3_3":
-                # Handle affine transforms (already implemented)
-                transform_params = np.array(f[f"TransformGroup/{key}/TransformParameters"][:])
-                print(f"Transform Parameters Length: {len(transform_params)}")
-
-                if len(transform_params) == 15:  # Handle center of rotation
-                    affine_matrix = np.reshape(transform_params[:9], (3, 3))
-                    translation = transform_params[9:12]
-                    center = transform_params[12:]
-                    points = np.dot(points - center, affine_matrix.T) + center + translation
-
-                elif len(transform_params) == 12:  # Standard affine transformation
-                    affine_matrix = np.reshape(transform_params[:9], (3, 3))
-                    translation = transform_params[9:]
-                    points = np.dot(points, affine_matrix.T) + translation
-
-                else:
-                    raise ValueError("Unexpected affine parameter length.")
-
-            elif transform_type == "DisplacementFieldTransform_double_3_3":
-                # Handle displacement field
-                displacement_field = np.array(f[f"TransformGroup/{key}/TransformParameters"][:])
-                field_shape = displacement_field.shape
-
-                print(f"Displacement Field Shape: {field_shape}")
-                if len(field_shape) == 1:  # Flattened displacement field
-                    # Assuming the field represents a 3D volume and needs reshaping
-                    grid_size = int(round(len(displacement_field) ** (1 / 3)))  # Assuming cubic grid
-                    displacement_field = displacement_field.reshape((grid_size, grid_size, grid_size, 3))
-
-                for point in points:
-                    x, y, z = point.astype(int)
-                    displacement = displacement_field[x, y, z]
-                    point += displacement
-
-            elif transform_type == "CompositeTransform_double_3_3":
-                # Handle composite transforms
-                print(f"Composite transform requires sequential handling of sub-transforms.")
-                # Add handling for nested transforms if required.
-
-            else:
-                raise ValueError(f"Unsupported TransformType: {transform_type}")
-
-    return points
+    chain = read_transform_chain(transform_file)
+    print(f"Transform chain: {' -> '.join(kind for kind, *_ in chain)}")
+    return apply_transform_chain(points, chain)
 
 # Evaluation Functions
 def compute_tre(points_fixed, points_warped):
@@ -133,28 +67,21 @@ def compute_dsc(fixed, warped):
     union = fixed_bin.sum() + warped_bin.sum()
     return 2 * intersection / union if union > 0 else 0.0
 
-def compute_hd95(fixed, warped):
-    """Compute 95th percentile Hausdorff Distance (HD95)."""
-    fixed_bin = fixed > 0
-    warped_bin = warped > 0
-    fixed_dt = distance_transform_edt(~fixed_bin)
-    warped_dt = distance_transform_edt(~warped_bin)
-    fw_distances = fixed_dt[warped_bin].ravel()
-    bw_distances = warped_dt[fixed_bin].ravel()
-    hd95 = max(np.percentile(fw_distances, 95), np.percentile(bw_distances, 95))
-    return hd95
-
 def compute_intensity_correlation(fixed, warped):
     """Compute Pearson correlation between fixed and warped."""
-    fixed_flat = fixed.ravel()
-    warped_flat = warped.ravel()
-    correlation, _ = pearsonr(fixed_flat, warped_flat)
-    return correlation
+    return compute_ncc(fixed, warped)
 
 # Main Evaluation Function
-def evaluate(fixed_path, warped_path, transform_file, kp_fixed=None, kp_moving=None, lm_fixed=None, lm_moving=None):
-    fixed_image = load_image(fixed_path)
-    warped_image = load_image(warped_path)
+def load_case(fixed_path, warped_path, roi=None):
+    """
+    Load the fixed and warped images of one case as arrays on the fixed grid, with the (z, y, x) spacing.
+
+    With a (z, y, x) ROI of the fixed grid, only that region of the fixed image and the part of
+    the warped image covering it are decoded and resampled.
+    """
+    fixed, warped = Volume(fixed_path), Volume(warped_path)
+    fixed_image = fixed.read_image(roi)
+    warped_image = warped.read_image(warped.roi_covering(fixed, roi))
 
     # Resampling if needed
     warped_resampled = resample_image(warped_image, fixed_image)
@@ -162,20 +89,68 @@ def evaluate(fixed_path, warped_path, transform_file, kp_fixed=None, kp_moving=N
     # Converting to numpy arrays
     fixed_np = sitk.GetArrayFromImage(fixed_image)
     warped_np = sitk.GetArrayFromImage(warped_resampled)
-
-
+    spacing = fixed_image.GetSpacing()[::-1]
+    return fixed_np, warped_np, spacing
+
+def load_segmentations(fixed_seg_path, warped_seg_path, roi=None):
+    """Load fixed and warped label maps (optionally a ROI), resampled with nearest neighbour onto the fixed grid."""
+    fixed, warped = Volume(fixed_seg_path), Volume(warped_seg_path)
+    fixed_seg = fixed.read_image(roi)
+    warped_seg = resample_image(warped.read_image(warped.roi_covering(fixed, roi)), fixed_seg, sitk.sitkNearestNeighbor)
+    return sitk.GetArrayFromImage(fixed_seg), sitk.GetArrayFromImage(warped_seg)
+
+def compute_metrics(fixed_np, warped_np, transform_file, spacing=None, kp_fixed=None, kp_moving=None, lm_fixed=None, lm_moving=None,
+                    fixed_seg=None, warped_seg=None, disp_file=None):
+    """Compute all registration metrics of one case."""
     kp_warped = apply_transformation(kp_moving, transform_file) if kp_moving is not None else None
     lm_warped = apply_transformation(lm_moving, transform_file) if lm_moving is not None else None
 
-    # Computing metrics
+    similarity = compute_similarity(fixed_np, warped_np)
+
     results = {
         "TRE_kp": compute_tre(kp_fixed, kp_warped) if kp_fixed is not None and kp_warped is not None else "N/A",
         "TRE_lm": compute_tre(lm_fixed, lm_warped) if lm_fixed is not None and lm_warped is not None else "N/A",
         "DSC": compute_dsc(fixed_np, warped_np),
-        "HD95": compute_hd95(fixed_np, warped_np),
-        "Intensity Correlation": compute_intensity_correlation(fixed_np, warped_np),
+        "HD95": compute_hd95(fixed_np, warped_np, spacing),
+        "Intensity Correlation": similarity["NCC"],
+        "LNCC": similarity["LNCC"],
+        "MI": similarity["MI"],
     }
 
+    # Per-structure DSC and HD95 when label maps are given, averaged as on the leaderboard
+    if fixed_seg is not None and warped_seg is not None:
+        label_results = compute_multilabel_metrics(fixed_seg, warped_seg, spacing)
+        for metric in ("DSC", "HD95"):
+            values = [label_metrics[metric] for label_metrics in label_results.values()]
+            results[metric] = float(np.mean(values)) if values else "N/A"
+            for label, label_metrics in label_results.items():
+                results[f"{metric}_{label}"] = label_metrics[metric]
+
+    # Regularity of the displacement field (disp_*.nii.gz or the .hdf5 transform)
+    if disp_file is not None:
+        field, _, field_spacing, direction = read_field(disp_file)
+        results.update(jacobian_statistics(field, field_spacing, direction))
+
+    return results
+
+def evaluate(fixed_path, warped_path, transform_file, kp_fixed=None, kp_moving=None, lm_fixed=None, lm_moving=None,
+             fixed_seg_path=None, warped_seg_path=None, disp_file=None, roi=None):
+    fixed_np, warped_np, spacing = load_case(fixed_path, warped_path, roi)
+    fixed_seg, warped_seg = (
+        load_segmentations(fixed_seg_path, warped_seg_path, roi) if fixed_seg_path and warped_seg_path else (None, None)
+    )
+
+    # Computing metrics
+    results = compute_metrics(
+        fixed_np, warped_np, transform_file, spacing=spacing,
+        kp_fixed=kp_fixed, kp_moving=kp_moving,
+        lm_fixed=lm_fixed, lm_moving=lm_moving,
+        fixed_seg=fixed_seg, warped_seg=warped_seg, disp_file=disp_file
+    )
+    report(results, fixed_np, warped_np)
+
+def report(results, fixed_np, warped_np):
+    """Print and save the results and show the middle slice of the fixed, warped and difference images."""
     print("\nAggregated Results:")
     for key, value in results.items():
         print(f"{key:<20}: {value:.5f}" if value != "N/A" else f"{key:<20}: N/A")
@@ -208,7 +183,20 @@ if __name__ == "__main__":
     parser.add_argument("--lm_fixed", help="Path to the fixed landmarks file.")
     parser.add_argument("--lm_moving", help="Path to the moving landmarks file.")
     parser.add_argument("--transform_file", required=True, help="Path to the transformation file.")
+
+    # Optional label maps for per-structure DSC/HD95
+    parser.add_argument("--fixed_seg", help="Path to the fixed label map.")
+    parser.add_argument("--warped_seg", help="Path to the warped moving label map.")
+
+    # Optional displacement field for Jacobian statistics
+    parser.add_argument("--disp", help="Path to the disp_*.nii.gz field (or .hdf5 transform) for Jacobian statistics.")
+
+    # Optional region of interest of the fixed grid; only its voxels are read
+    parser.add_argument("--roi", type=parse_roi, help="Region 'z0:z1,y0:y1,x0:x1' of the fixed grid to evaluate.")
+    parser.add_argument("--roi_from_seg", type=int, metavar="MARGIN", help="Evaluate the bounding box of the fixed label map plus MARGIN voxels.")
     args = parser.parse_args()
+    if args.roi_from_seg is not None and not args.fixed_seg:
+        parser.error("--roi_from_seg requires --fixed_seg")
 
     # Loading opt. keypoints/landmarks
     kp_fixed = load_csv(args.kp_fixed)
@@ -216,8 +204,14 @@ if __name__ == "__main__":
     lm_fixed = load_csv(args.lm_fixed)
     lm_moving = load_csv(args.lm_moving)
 
+    roi = args.roi
+    if args.roi_from_seg is not None:
+        roi = mask_bounding_box(Volume(args.fixed_seg), margin=args.roi_from_seg)
+
     evaluate(
         args.fixed, args.warped, args.transform_file, 
         kp_fixed=kp_fixed, kp_moving=kp_moving, 
-        lm_fixed=lm_fixed, lm_moving=lm_moving
+        lm_fixed=lm_fixed, lm_moving=lm_moving,
+        fixed_seg_path=args.fixed_seg, warped_seg_path=args.warped_seg,
+        disp_file=args.disp, roi=roi
     )    
\ No newline at end of file
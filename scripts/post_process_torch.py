@@ -1,102 +1,385 @@
 import argparse
 import os
 import numpy as np
-import nrrd
 import h5py
+import nibabel as nib
+import SimpleITK as sitk
 import torch
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
-from scipy.ndimage import distance_transform_edt
-from scipy.stats import pearsonr
+
+# Torch-native counterpart of post_process.py: images are loaded once into tensors and
+# resampling, DSC, HD95, NCC and Jacobian statistics run as tensor ops on one device,
+# batched over cases of the same fixed grid.
+# python scripts/post_process_torch.py --fixed=... --warped=... [--disp=output/reshaped_validation/disp_*.nii.gz]
+# python scripts/post_process_torch.py --data_path input/Release_06_12_23 --results_dir output --phase val
+
+SITK_SUFFIXES = (".nii", ".nii.gz", ".nrrd", ".nhdr", ".mha", ".mhd")
+
+def image_suffix(file_path):
+    """File suffix, with .nii.gz kept whole."""
+    name = os.path.basename(file_path).lower()
+    return ".nii.gz" if name.endswith(".nii.gz") else os.path.splitext(name)[1]
+
+def make_geometry(origin, spacing, direction):
+    """Physical geometry of an image grid in ITK (LPS) conventions, as float64 tensors."""
+    return {
+        "origin": torch.tensor(origin, dtype=torch.float64),
+        "spacing": torch.tensor(spacing, dtype=torch.float64),
+        "direction": torch.tensor(direction, dtype=torch.float64).reshape(3, 3),
+    }
 
 # Loaders for Different File Types
-def load_image(file_path):
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext in [".nrrd", ".nhdr"]:
-        img, _ = nrrd.read(file_path)
-        return torch.Tensor(img).unsqueeze(0).unsqueeze(0)
-    elif ext in [".nii", ".nii.gz"]:
-        img = sitk.GetArrayFromImage(sitk.ReadImage(file_path))
-        return torch.Tensor(img).unsqueeze(0).unsqueeze(0)
+def load_image(file_path, device="cpu", pixel_type=sitk.sitkFloat32):
+    """Load an image as a [1, 1, z, y, x] tensor on device, with its geometry."""
+    ext = image_suffix(file_path)
+    if ext in SITK_SUFFIXES:
+        image = sitk.ReadImage(file_path, pixel_type)
+        array = sitk.GetArrayFromImage(image)
+        geometry = make_geometry(image.GetOrigin(), image.GetSpacing(), image.GetDirection())
     elif ext == ".hdf5":
         with h5py.File(file_path, "r") as f:
-            img = f["warped_image"][:]
-        return torch.Tensor(img).unsqueeze(0).unsqueeze(0)
+            array = f["warped_image"][:].astype(np.float32)
+        geometry = make_geometry((0, 0, 0), (1, 1, 1), np.eye(3).ravel())
     else:
         raise ValueError(f"Unsupported file format: {ext}")
+    return torch.from_numpy(array)[None, None].to(device), geometry
+
+def load_displacement(file_path, device="cpu"):
+    """Load a disp_*.nii.gz field ((x, y, z, 3) in mm) as a [3, z, y, x] tensor with its geometry."""
+    image = nib.load(file_path)
+    field = torch.from_numpy(np.asanyarray(image.dataobj).astype(np.float32, copy=False))
+    field = field.reshape(*field.shape[:3], 3).permute(3, 2, 1, 0).to(device)
+
+    # NIfTI affines are RAS, the field and ITK geometry are LPS
+    affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ image.affine
+    spacing = np.linalg.norm(affine[:3, :3], axis=0)
+    return field, make_geometry(affine[:3, 3], spacing, (affine[:3, :3] / spacing).ravel())
 
 # Preprocessing Function
-def preprocess(img, img_type="mri"):
+def preprocess(img, img_type="ct"):
+    """Normalize intensities to [0, 1] the way the network input is prepared for the given modality."""
     if img_type == "ct":
         clamp = [-1000, 1000]
         img = (torch.clamp(img, clamp[0], clamp[1]) - clamp[0]) / (clamp[1] - clamp[0])
     elif img_type == "mri":
-        im_min, im_max = torch.min(img), torch.quantile(img, 0.99)
+        values = img.flatten()
+        im_min = values.min()
+        im_max = values.kthvalue(max(1, int(round(0.99 * values.numel())))).values
         img = torch.clip(img, im_min, im_max)
         img = (img - im_min) / (im_max - im_min)
     else:
         raise ValueError(f"Unsupported image type: {img_type}")
-    return F.interpolate(img, [175, 175, 175], mode="trilinear", align_corners=False)
+    return img
+
+# Resampling to the fixed grid
+def index_to_physical(geometry):
+    """4x4 matrix mapping (x, y, z) voxel indices to physical coordinates."""
+    matrix = torch.eye(4, dtype=torch.float64)
+    matrix[:3, :3] = geometry["direction"] * geometry["spacing"]
+    matrix[:3, 3] = geometry["origin"]
+    return matrix
+
+def resample_image(image, geometry, reference_geometry, reference_shape, mode="bilinear", slab_size=32):
+    """
+    Resample a [N, C, z, y, x] image onto a reference grid of shape (z, y, x) through physical space.
+
+    Matches SimpleITK resampling: linear ("bilinear") or nearest interpolation, voxels mapping
+    outside the image buffer are 0. The sampling grid is built one z-slab at a time.
+    """
+    device = image.device
+    size = torch.tensor(image.shape[:1:-1], dtype=torch.float64)  # (x, y, z)
+    mapping = torch.linalg.solve(index_to_physical(geometry), index_to_physical(reference_geometry))
+    scale = 2 / (size - 1).clamp(min=1)
+    rotation = (mapping[:3, :3] * scale[:, None]).float().to(device)
+    offset = (mapping[:3, 3] * scale - 1).float().to(device)
+    lower = (-0.5 * scale - 1).float().to(device)
+    upper = ((size - 0.5) * scale - 1).float().to(device)
+
+    depth, height, width = reference_shape
+    i = torch.arange(width, device=device, dtype=torch.float32)[None, None, :, None]
+    j = torch.arange(height, device=device, dtype=torch.float32)[None, :, None, None]
+    output = image.new_empty((*image.shape[:2], depth, height, width))
+    for start in range(0, depth, slab_size):
+        stop = min(start + slab_size, depth)
+        k = torch.arange(start, stop, device=device, dtype=torch.float32)[:, None, None, None]
+        grid = i * rotation[:, 0] + j * rotation[:, 1] + k * rotation[:, 2] + offset  # [z, y, x, 3] normalized
+        inside = ((grid >= lower) & (grid <= upper)).all(-1)
+        grid = grid[None].expand(image.shape[0], -1, -1, -1, -1)
+        slab = F.grid_sample(image, grid, mode=mode, padding_mode="border", align_corners=True)
+        output[:, :, start:stop] = slab * inside
+    return output
 
 # Evaluation Functions
 def compute_dsc(fixed, warped):
-    fixed_bin = fixed > 0
-    warped_bin = warped > 0
-    intersection = torch.logical_and(fixed_bin, warped_bin).sum().item()
-    union = fixed_bin.sum().item() + warped_bin.sum().item()
-    return 2 * intersection / union if union > 0 else 0.0
-
-def compute_hd95(fixed, warped):
-    fixed_bin = fixed > 0
-    warped_bin = warped > 0
-    fw_distances = distance_transform_edt(~fixed_bin.numpy())[warped_bin.numpy()].ravel()
-    bw_distances = distance_transform_edt(~warped_bin.numpy())[fixed_bin.numpy()].ravel()
-    hd95 = max(np.percentile(fw_distances, 95), np.percentile(bw_distances, 95))
-    return hd95
+    """DSC between the foregrounds (> 0) of [N, ...] batches, one value per case."""
+    fixed_bin = (fixed > 0).flatten(1)
+    warped_bin = (warped > 0).flatten(1)
+    intersection = (fixed_bin & warped_bin).sum(1)
+    total = fixed_bin.sum(1) + warped_bin.sum(1)
+    return torch.where(total > 0, 2 * intersection / total.clamp(min=1), torch.zeros_like(total, dtype=torch.float32))
 
 def compute_intensity_correlation(fixed, warped):
-    fixed_flat = fixed.view(-1)
-    warped_flat = warped.view(-1)
-    correlation, _ = pearsonr(fixed_flat.numpy(), warped_flat.numpy())
-    return correlation
+    """Pearson correlation (NCC) of [N, ...] batches, one value per case."""
+    x = fixed.flatten(1)
+    y = warped.flatten(1)
+    x = x - x.mean(1, keepdim=True)
+    y = y - y.mean(1, keepdim=True)
+    return (x * y).sum(1) / torch.sqrt((x * x).sum(1) * (y * y).sum(1)).clamp(min=1e-12)
+
+def surface(mask):
+    """Boundary voxels (6-connected erosion, zero border) of a [..., z, y, x] boolean mask."""
+    p = F.pad(mask.to(torch.uint8), (1, 1, 1, 1, 1, 1)).bool()
+    eroded = (
+        p[..., 1:-1, 1:-1, 1:-1]
+        & p[..., :-2, 1:-1, 1:-1] & p[..., 2:, 1:-1, 1:-1]
+        & p[..., 1:-1, :-2, 1:-1] & p[..., 1:-1, 2:, 1:-1]
+        & p[..., 1:-1, 1:-1, :-2] & p[..., 1:-1, 1:-1, 2:]
+    )
+    return mask & ~eroded
+
+def line_distance_squared(features, dim, step):
+    """Squared distance to the nearest feature voxel along one axis (inf if the line has none)."""
+    n = features.shape[dim]
+    shape = [1] * features.dim()
+    shape[dim] = n
+    index = torch.arange(n, device=features.device).view(shape)
+    left = torch.where(features, index, -2 * n).cummax(dim).values
+    right = torch.where(features, index, 3 * n).flip(dim).cummin(dim).values.flip(dim)
+    distance = torch.minimum(index - left, right - index)
+    return torch.where(distance < 2 * n, (distance * step).float() ** 2, torch.inf)
+
+def parabola_pass(f, dim, step, check_every=4):
+    """
+    Exact EDT pass: min over offsets k of f(i + k) + (k * step)^2 along dim.
+
+    Offsets grow until (k * step)^2 exceeds every value of a line, and lines are dropped from
+    the working set as soon as they are final, so the work follows the local distances.
+    """
+    moved = f.movedim(dim, -1)
+    lines = moved.reshape(-1, moved.shape[-1])
+    n = lines.shape[1]
+    result = lines.clone()
+
+    # Lines without any finite value stay infinite
+    active = torch.nonzero(torch.isfinite(lines).any(1)).flatten()
+    source = lines[active]
+    current = source.clone()
+    for k in range(1, n):
+        if (k - 1) % check_every == 0:
+            keep = current.amax(1) > (k * step) ** 2
+            if not keep.all():
+                result[active[~keep]] = current[~keep]
+                active, source, current = active[keep], source[keep], current[keep]
+            if len(active) == 0:
+                break
+        cost = (k * step) ** 2
+        torch.minimum(current[:, :n - k], source[:, k:] + cost, out=current[:, :n - k])
+        torch.minimum(current[:, k:], source[:, :n - k] + cost, out=current[:, k:])
+    result[active] = current
+    return result.reshape(moved.shape).movedim(-1, dim)
+
+def distance_transform(features, spacing=(1.0, 1.0, 1.0)):
+    """Exact Euclidean distance of every voxel of a [z, y, x] grid to the nearest True voxel."""
+    squared = line_distance_squared(features, 2, float(spacing[2]))
+    squared = parabola_pass(squared, 1, float(spacing[1]))
+    squared = parabola_pass(squared, 0, float(spacing[0]))
+    return squared.sqrt()
+
+def hd95_binary(fixed_bin, warped_bin, spacing=None, margin=1):
+    """HD95 between the surfaces of two [z, y, x] masks, cropped to their union bounding box plus a margin."""
+    if not fixed_bin.any() or not warped_bin.any():
+        return float("inf")
+    spacing = spacing if spacing is not None else (1.0, 1.0, 1.0)
+
+    union = fixed_bin | warped_bin
+    box = []
+    for dim in range(3):
+        occupied = torch.nonzero(union.any(dim=[d for d in range(3) if d != dim]))
+        box.append(slice(max(int(occupied[0]) - margin, 0), int(occupied[-1]) + 1 + margin))
+    fixed_surface = surface(fixed_bin[tuple(box)])
+    warped_surface = surface(warped_bin[tuple(box)])
 
-# Main Evaluation Function
-def evaluate(fixed_path, warped_path):
-    fixed_image = load_image(fixed_path)
-    warped_image = load_image(warped_path)
+    fw_distances = distance_transform(fixed_surface, spacing)[warped_surface]
+    bw_distances = distance_transform(warped_surface, spacing)[fixed_surface]
+    return max(
+        torch.quantile(fw_distances.double(), 0.95).item(),
+        torch.quantile(bw_distances.double(), 0.95).item(),
+    )
+
+def compute_hd95(fixed, warped, spacing=None):
+    """HD95 between the foregrounds (> 0) of [N, 1, z, y, x] batches, one value per case."""
+    return [hd95_binary(f[0] > 0, w[0] > 0, spacing) for f, w in zip(fixed, warped)]
+
+def compute_label_metrics(fixed_seg, warped_seg, spacing=None):
+    """Per-label DSC and HD95 of a [1, 1, z, y, x] pair of label maps."""
+    labels = torch.unique(torch.cat([fixed_seg.unique(), warped_seg.unique()]))
+    results = {}
+    for label in labels[labels != 0].tolist():
+        fixed_bin, warped_bin = fixed_seg[0, 0] == label, warped_seg[0, 0] == label
+        total = fixed_bin.sum() + warped_bin.sum()
+        results[int(label)] = {
+            "DSC": (2 * (fixed_bin & warped_bin).sum() / total).item(),
+            "HD95": hd95_binary(fixed_bin, warped_bin, spacing),
+        }
+    return results
+
+def jacobian_determinant(disp, geometry, slab_size=32):
+    """
+    Jacobian determinant of x -> x + u(x) for a [3, z, y, x] displacement field in mm.
+
+    Central differences (one-sided at the borders) in z-slabs with a one-slice halo, with
+    derivatives taken w.r.t. physical coordinates using the field's spacing and direction.
+    """
+    sx, sy, sz = geometry["spacing"].tolist()
+    direction_t = geometry["direction"].T.float().to(disp.device)
+    depth = disp.shape[1]
+    determinant = disp.new_empty(disp.shape[1:])
+    for start in range(0, depth, slab_size):
+        stop = min(start + slab_size, depth)
+        lo, hi = max(start - 1, 0), min(stop + 1, depth)
+        slab = disp[:, lo:hi]
+        if hi - lo > 1:
+            d_dz, d_dy, d_dx = torch.gradient(slab, spacing=(sz, sy, sx), dim=(1, 2, 3))
+        else:
+            d_dz = torch.zeros_like(slab)
+            d_dy, d_dx = torch.gradient(slab, spacing=(sy, sx), dim=(2, 3))
+        core = slice(start - lo, stop - lo)
+        # grad[..., c, a]: derivative of u_c along grid axis a (x, y, z), then rotated to physical axes
+        grad = torch.stack([d_dx[:, core], d_dy[:, core], d_dz[:, core]], -1).movedim(0, -2)
+        jacobian = grad @ direction_t + torch.eye(3, device=disp.device)
+        determinant[start:stop] = torch.linalg.det(jacobian)
+    return determinant
+
+def jacobian_statistics(disp, geometry):
+    """Standard deviation of the log Jacobian determinant and the number of folded voxels (det <= 0)."""
+    determinant = jacobian_determinant(disp, geometry)
+    log_jac = torch.log(determinant.clamp(1e-9, 1e9))
+    return {"LogJacDetStd": log_jac.double().std(correction=0).item(), "num_foldings": int((determinant <= 0).sum())}
+
+# Main Evaluation Functions
+def load_case(fixed_path, warped_path, device="cpu", fixed_modality=None, moving_modality=None):
+    """Fixed image and warped image resampled onto the fixed grid, as [1, 1, z, y, x] tensors."""
+    fixed, fixed_geometry = load_image(fixed_path, device)
+    warped, warped_geometry = load_image(warped_path, device)
+    warped = resample_image(warped, warped_geometry, fixed_geometry, fixed.shape[2:])
+    if fixed_modality:
+        fixed = preprocess(fixed, fixed_modality)
+    if moving_modality:
+        warped = preprocess(warped, moving_modality)
+    return fixed, warped, fixed_geometry
+
+def evaluate_cases(cases, device="cpu", fixed_modality=None, moving_modality=None):
+    """
+    Evaluate cases given as dicts with 'fixed' and 'warped' paths and optional 'disp' (validation
+    field) and 'fixed_seg'/'warped_seg' (label maps). Cases with the same fixed grid shape are
+    stacked and their DSC and NCC computed as one batch.
+    """
+    loaded = [load_case(case["fixed"], case["warped"], device, fixed_modality, moving_modality) for case in cases]
+    results = [{} for _ in cases]
+
+    groups = {}
+    for index, (fixed, _, _) in enumerate(loaded):
+        groups.setdefault(tuple(fixed.shape), []).append(index)
+    for indices in groups.values():
+        fixed = torch.cat([loaded[i][0] for i in indices])
+        warped = torch.cat([loaded[i][1] for i in indices])
+        for i, dsc, ncc in zip(indices, compute_dsc(fixed, warped).tolist(), compute_intensity_correlation(fixed, warped).tolist()):
+            results[i]["DSC"] = dsc
+            results[i]["Intensity Correlation"] = ncc
+
+    for case, (fixed, warped, geometry), case_results in zip(cases, loaded, results):
+        spacing = geometry["spacing"].tolist()[::-1]
+        case_results["HD95"] = compute_hd95(fixed, warped, spacing)[0]
 
-    # Resample using PyTorch
-    fixed_resampled = preprocess(fixed_image, "mri")
-    warped_resampled = preprocess(warped_image, "mri")
+        # Per-structure DSC and HD95 when label maps are given, averaged as in post_process.py
+        if case.get("fixed_seg") and case.get("warped_seg"):
+            fixed_seg, _ = load_image(case["fixed_seg"], device, sitk.sitkInt32)
+            warped_seg, warped_seg_geometry = load_image(case["warped_seg"], device, sitk.sitkFloat32)
+            warped_seg = resample_image(warped_seg, warped_seg_geometry, geometry, fixed_seg.shape[2:], mode="nearest")
+            label_results = compute_label_metrics(fixed_seg, warped_seg.round().int(), spacing)
+            for metric in ("DSC", "HD95"):
+                values = [label_metrics[metric] for label_metrics in label_results.values()]
+                case_results[metric] = float(np.mean(values)) if values else "N/A"
+                for label, label_metrics in label_results.items():
+                    case_results[f"{metric}_{label}"] = label_metrics[metric]
 
-    # Metrics
-    dsc = compute_dsc(fixed_resampled, warped_resampled)
-    hd95 = compute_hd95(fixed_resampled, warped_resampled)
-    correlation = compute_intensity_correlation(fixed_resampled, warped_resampled)
+        if case.get("disp"):
+            case_results.update(jacobian_statistics(*load_displacement(case["disp"], device)))
+    return results, loaded
+
+def evaluate(fixed_path, warped_path, disp_path=None, fixed_seg_path=None, warped_seg_path=None, device="cpu",
+             fixed_modality=None, moving_modality=None):
+    case = {"fixed": fixed_path, "warped": warped_path, "disp": disp_path,
+            "fixed_seg": fixed_seg_path, "warped_seg": warped_seg_path}
+    [results], [(fixed, warped, _)] = evaluate_cases([case], device, fixed_modality, moving_modality)
 
     print("\nAggregated Results:")
-    print(f"DSC                 : {dsc:.5f}")
-    print(f"HD95                : {hd95:.5f}")
-    print(f"Intensity Correlation: {correlation:.5f}")
+    for key, value in results.items():
+        print(f"{key:<20}: {value:.5f}" if value != "N/A" else f"{key:<20}: N/A")
 
     # Visualization
-    slice_idx = fixed_resampled.shape[2] // 2
+    slice_idx = fixed.shape[2] // 2
+    fixed_slice = fixed[0, 0, slice_idx].cpu()
+    warped_slice = warped[0, 0, slice_idx].cpu()
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
-    axes[0].imshow(fixed_resampled[0, 0, slice_idx].numpy(), cmap="gray")
+    axes[0].imshow(fixed_slice.numpy(), cmap="gray")
     axes[0].set_title("Fixed Image")
-    axes[1].imshow(warped_resampled[0, 0, slice_idx].numpy(), cmap="gray")
+    axes[1].imshow(warped_slice.numpy(), cmap="gray")
     axes[1].set_title("Warped Image")
-    axes[2].imshow(
-        torch.abs(fixed_resampled[0, 0, slice_idx] - warped_resampled[0, 0, slice_idx]).numpy(),
-        cmap="hot",
-    )
+    axes[2].imshow(torch.abs(fixed_slice - warped_slice).numpy(), cmap="hot")
     axes[2].set_title("Difference (Fixed - Warped)")
     plt.show()
+    return results
+
+def evaluate_split(data_path, results_dir, phase="val", batch_size=4, device="cpu", output_dir="outputs"):
+    """Evaluate every registered pair of a split in batches of batch_size cases."""
+    from evaluate_batch import aggregate, discover_cases
+    from post_process import save_results
+
+    cases = discover_cases(data_path, results_dir, phase)
+    for case in cases:
+        case["disp"] = case["disp_file"]
+    print(f"Evaluating {len(cases)} cases from the '{phase}' split.")
+
+    case_results = {}
+    for start in range(0, len(cases), batch_size):
+        batch = cases[start:start + batch_size]
+        for case, results in zip(batch, evaluate_cases(batch, device)[0]):
+            case_results[case["name"]] = results
+            print(f"Finished {case['name']}")
+
+    aggregated = {"aggregates": aggregate(case_results), "cases": case_results}
+    print("\nAggregated Results:")
+    for key, value in aggregated["aggregates"].items():
+        print(f"{key:<22}: mean {value['mean']:.5f}  std {value['std']:.5f}  30% {value['30']:.5f}")
+    save_results(aggregated, output_dir=output_dir, prefix="aggregated_results_torch")
+    return aggregated
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Evaluate registration metrics.")
-    parser.add_argument("--fixed", required=True, help="Path to the fixed image (.nrrd, .nii, .hdf5).")
-    parser.add_argument("--warped", required=True, help="Path to the warped image (.nrrd, .nii, .hdf5).")
+    parser = argparse.ArgumentParser(description="Evaluate registration metrics with PyTorch.")
+    parser.add_argument("--fixed", help="Path to the fixed image (.nrrd, .nii, .nii.gz, .hdf5).")
+    parser.add_argument("--warped", help="Path to the warped image (.nrrd, .nii, .nii.gz, .hdf5).")
+    parser.add_argument("--disp", help="Path to the disp_*.nii.gz displacement field for Jacobian statistics.")
+    parser.add_argument("--fixed_seg", help="Path to the fixed label map.")
+    parser.add_argument("--warped_seg", help="Path to the warped moving label map.")
+    parser.add_argument("--fixed_modality", choices=["mri", "ct"], help="Normalize the fixed image like the network input.")
+    parser.add_argument("--moving_modality", choices=["mri", "ct"], help="Normalize the warped image like the network input.")
+
+    # Whole split instead of a single pair
+    parser.add_argument("--data_path", help="Dataset directory containing ThoraxCBCT_dataset.json.")
+    parser.add_argument("--results_dir", default="output", help="Directory with warped_*.nii.gz and disp_*.hdf5 outputs.")
+    parser.add_argument("--phase", default="val", choices=["val", "test"], help="Dataset split to evaluate.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Cases evaluated together.")
+    parser.add_argument("--device", default="cpu", help="Torch device, e.g. cpu or cuda.")
     args = parser.parse_args()
 
-    evaluate(args.fixed, args.warped)
\ No newline at end of file
+    if args.data_path:
+        evaluate_split(args.data_path, args.results_dir, args.phase, args.batch_size, args.device)
+    elif args.fixed and args.warped:
+        evaluate(
+            args.fixed, args.warped, args.disp, args.fixed_seg, args.warped_seg, args.device,
+            args.fixed_modality, args.moving_modality,
+        )
+    else:
+        parser.error("Either --fixed and --warped or --data_path is required.")
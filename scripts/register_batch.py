@@ -0,0 +1,100 @@
+import argparse
+import csv
+import os
+import time
+
+from oncoreg import load_pairs, pair_name
+from pipeline import run_pipeline
+from registration import load_network, load_pair, run_registration, write_outputs
+
+# python scripts/register_batch.py --data_path input/Release_06_12_23 --phase test --io_iterations 50
+
+def read_manifest(manifest_path):
+    """Read fixed/moving pairs from a CSV manifest with 'fixed' and 'moving' columns."""
+    with open(manifest_path, newline="") as f:
+        return [{"fixed": row["fixed"], "moving": row["moving"]} for row in csv.DictReader(f)]
+
+def output_paths(pair, output_dir):
+    name = pair_name(pair["fixed"], pair["moving"])
+    return {
+        "transform_out": os.path.join(output_dir, f"disp_{name}.hdf5"),
+        "warped_out": os.path.join(output_dir, f"warped_{name}.nii.gz"),
+        "disp_out": os.path.join(output_dir, "reshaped_validation", f"disp_{name}.nii.gz"),
+    }
+
+def register_batch(pairs, output_dir="output", io_iterations=50, io_sim="lncc", model="unigradicon",
+                   fixed_modality="ct", moving_modality="ct", skip_existing=False,
+                   load_workers=2, write_workers=2, queue_size=2, io_cache_dir=None):
+    """
+    Register every pair with a single network instance.
+
+    Pairs flow through three pipelined stages (load/preprocess, network + IO, write/convert),
+    so reading pair N + 1 and writing pair N - 1 overlap the registration of pair N. The
+    network stage has a single worker; queue_size bounds the pairs held between stages.
+    With io_cache_dir, instance optimization resumes from cached states (see io_cache).
+    """
+    os.makedirs(os.path.join(output_dir, "reshaped_validation"), exist_ok=True)
+
+    jobs = []
+    for pair in pairs:
+        outputs = output_paths(pair, output_dir)
+        if skip_existing and all(os.path.exists(path) for path in outputs.values()):
+            print(f"Skipping {outputs['transform_out']}: outputs exist.")
+            continue
+        jobs.append((pair, outputs))
+    if not jobs:
+        return
+
+    print(f"Loading {model} network...")
+    net = load_network(io_sim, model)
+
+    def load(job):
+        pair, outputs = job
+        return outputs, load_pair(pair["fixed"], pair["moving"], fixed_modality, moving_modality)
+
+    def register(loaded):
+        outputs, pair = loaded
+        return outputs, pair, run_registration(net, pair, io_iterations, io_cache_dir, io_sim)
+
+    def write(registered):
+        outputs, pair, phi_AB = registered
+        write_outputs(pair, phi_AB, **outputs)
+
+    stages = [("load", load, load_workers), ("register", register, 1), ("write", write, write_workers)]
+    start = time.time()
+    for i, ((pair, outputs), _, error) in enumerate(run_pipeline(jobs, stages, queue_size), 1):
+        if error is not None:
+            print(f"[{i}/{len(jobs)}] Error registering '{pair['fixed']}' and '{pair['moving']}' ({error})")
+        else:
+            print(f"[{i}/{len(jobs)}] Registered {outputs['transform_out']} ({time.time() - start:.1f} s elapsed)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register all pairs of an OncoReg split or a CSV manifest.")
+    parser.add_argument("--data_path", help="Dataset directory containing ThoraxCBCT_dataset.json.")
+    parser.add_argument("--phase", default="test", choices=["train", "val", "test"], help="Dataset split to register.")
+    parser.add_argument("--manifest", help="CSV file with 'fixed' and 'moving' columns (instead of --data_path).")
+    parser.add_argument("--output_dir", default="output", help="Directory for the registration outputs.")
+    parser.add_argument("--fixed_modality", default="ct", choices=["mri", "ct"], help="Modality of the fixed images.")
+    parser.add_argument("--moving_modality", default="ct", choices=["mri", "ct"], help="Modality of the moving images.")
+    parser.add_argument("--io_iterations", type=int, default=50, help="Number of IO iterations (0 disables IO).")
+    parser.add_argument("--io_sim", default="lncc", choices=["lncc", "lncc2", "mind"], help="Similarity metric for IO.")
+    parser.add_argument("--model", default="unigradicon", choices=["unigradicon", "multigradicon"], help="Model to load.")
+    parser.add_argument("--skip_existing", action="store_true", help="Skip pairs whose outputs already exist.")
+    parser.add_argument("--load_workers", type=int, default=2, help="Threads reading and preprocessing pairs.")
+    parser.add_argument("--write_workers", type=int, default=2, help="Threads writing transforms, warped images and fields.")
+    parser.add_argument("--queue_size", type=int, default=2, help="Pairs buffered between pipeline stages.")
+    parser.add_argument("--io_cache_dir", help="Directory of cached IO states to warm-start from (e.g. output/cache/io).")
+    args = parser.parse_args()
+
+    if args.manifest:
+        pairs = read_manifest(args.manifest)
+    elif args.data_path:
+        pairs = load_pairs(args.data_path, args.phase)
+    else:
+        parser.error("Either --data_path or --manifest is required.")
+
+    register_batch(
+        pairs, args.output_dir, args.io_iterations, args.io_sim, args.model,
+        args.fixed_modality, args.moving_modality, args.skip_existing,
+        args.load_workers, args.write_workers, args.queue_size, args.io_cache_dir,
+    )
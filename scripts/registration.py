@@ -0,0 +1,93 @@
+import itk
+import SimpleITK as sitk
+
+import icon_registration.itk_wrapper
+from unigradicon import get_model_from_model_zoo, make_sim, maybe_cast, preprocess
+
+from data_transform_2 import export_displacement
+from io_cache import register_pair_cached
+
+# Networks loaded by get_network, keyed by (model, io_sim)
+_networks = {}
+
+# Stages of a single registration, shared by the batch driver and the interactive scripts
+def load_network(io_sim="lncc", model="unigradicon"):
+    """Load the uniGradICON (or multiGradICON) network with the similarity used for instance optimization."""
+    return get_model_from_model_zoo(model, make_sim(io_sim))
+
+def get_network(io_sim="lncc", model="unigradicon"):
+    """Network for the given model and IO similarity, loaded on first use and reused afterwards."""
+    key = (model, io_sim)
+    if key not in _networks:
+        _networks[key] = load_network(io_sim, model)
+    return _networks[key]
+
+def load_pair(fixed_path, moving_path, fixed_modality="ct", moving_modality="ct"):
+    """Read a fixed/moving pair and preprocess it for the network."""
+    fixed = itk.imread(str(fixed_path))
+    moving = itk.imread(str(moving_path))
+    return {
+        "fixed_path": str(fixed_path),
+        "fixed_modality": fixed_modality,
+        "moving_modality": moving_modality,
+        "fixed": fixed,
+        "moving": moving,
+        "fixed_input": preprocess(fixed, fixed_modality),
+        "moving_input": preprocess(moving, moving_modality),
+    }
+
+def run_registration(net, pair, io_iterations=50, io_cache_dir=None, io_sim="lncc"):
+    """
+    Register the moving image to the fixed image, with io_iterations of instance optimization (0 disables it).
+
+    With io_cache_dir, IO resumes from the closest cached state of the same pair, network and io_sim.
+    """
+    if io_cache_dir and io_iterations:
+        return register_pair_cached(
+            net, pair["moving_input"], pair["fixed_input"], io_iterations, io_cache_dir, io_sim,
+            pair["moving_modality"], pair["fixed_modality"],
+        )
+    phi_AB, _ = icon_registration.itk_wrapper.register_pair(
+        net, pair["moving_input"], pair["fixed_input"], finetune_steps=io_iterations or None
+    )
+    return phi_AB
+
+def warp_moving(pair, phi_AB):
+    """Resample the moving image onto the fixed image grid."""
+    moving, maybe_cast_back = maybe_cast(pair["moving"])
+    interpolator = itk.LinearInterpolateImageFunction.New(moving)
+    warped = itk.resample_image_filter(
+        moving,
+        transform=phi_AB,
+        interpolator=interpolator,
+        use_reference_image=True,
+        reference_image=pair["fixed"],
+    )
+    return maybe_cast_back(warped)
+
+def write_outputs(pair, phi_AB, transform_out, warped_out=None, disp_out=None, warped=None):
+    """Write the transform and, optionally, the warped moving image and the validation displacement field."""
+    itk.transformwrite([phi_AB], str(transform_out))
+    if warped_out:
+        itk.imwrite(warped if warped is not None else warp_moving(pair, phi_AB), str(warped_out))
+    if disp_out:
+        export_displacement(sitk.ReadTransform(str(transform_out)), pair["fixed_path"], disp_out)
+
+def register_pair(fixed, moving, modality="ct", io_iterations=50, io_sim="lncc", moving_modality=None,
+                  model="unigradicon", transform_out=None, warped_out=None, disp_out=None, io_cache_dir=None):
+    """
+    Register the moving image to the fixed image in this process and return (transform, warped image).
+
+    The network is loaded once per (model, io_sim) and kept for later calls. The ITK transform
+    and the warped moving image on the fixed grid are returned in memory; they are written to
+    disk only if the corresponding output paths are given (disp_out requires transform_out).
+    With io_cache_dir, instance optimization warm-starts from cached states (see io_cache).
+    """
+    pair = load_pair(fixed, moving, modality, moving_modality or modality)
+    phi_AB = run_registration(get_network(io_sim, model), pair, io_iterations, io_cache_dir, io_sim)
+    warped = warp_moving(pair, phi_AB)
+    if transform_out:
+        write_outputs(pair, phi_AB, transform_out, warped_out, disp_out, warped=warped)
+    elif warped_out:
+        itk.imwrite(warped, str(warped_out))
+    return phi_AB, warped
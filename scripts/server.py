@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from oncoreg import pair_name
+from registration import get_network, load_pair, run_registration, write_outputs
+
+# python scripts/server.py --port 5000 --input_root input --output_dir output/jobs
+#   curl localhost:5000/health
+#   curl -X POST localhost:5000/jobs -d '{"fixed": "Release_06_12_23/imagesTr/ThoraxCBCT_0011_0001.nii.gz", "moving": "..."}'
+#   curl -X PUT --data-binary @fixed.nii.gz localhost:5000/uploads/fixed.nii.gz
+#   curl localhost:5000/jobs/<id>  and  curl -O localhost:5000/jobs/<id>/disp
+
+IMAGE_SUFFIXES = (".nii.gz", ".nii", ".nrrd", ".nhdr", ".mha", ".mhd")
+OUTPUTS = ("transform", "warped", "disp")
+MAX_UPLOAD_SIZE = 2 ** 30
+
+class RegistrationService:
+    """Queue of registration jobs served by worker threads that share one warm network."""
+
+    def __init__(self, input_root="input", output_dir="output/jobs", io_sim="lncc", model="unigradicon",
+                 workers=1, max_queue=16):
+        self.input_root = Path(input_root).resolve()
+        self.upload_dir = Path(output_dir).resolve() / "uploads"
+        self.output_dir = Path(output_dir).resolve()
+        self.io_sim = io_sim
+        self.model = model
+        self.network = None
+        self.network_lock = threading.Lock()
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+
+        threading.Thread(target=self.load_network, daemon=True).start()
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def load_network(self):
+        with self.network_lock:
+            self.network = get_network(self.io_sim, self.model)
+        print(f"{self.model} network loaded.")
+
+    def resolve_input(self, path):
+        """Absolute path of an image on the input volume (or an upload); raises ValueError outside of them."""
+        path = Path(path)
+        for root in (self.input_root, self.upload_dir):
+            candidate = (root / path).resolve()
+            if candidate.is_relative_to(root) and candidate.is_file():
+                return candidate
+        raise ValueError(f"Image not found under {self.input_root} or the uploads: {path}")
+
+    def save_upload(self, name, stream, length):
+        if Path(name).name != name or not name.endswith(IMAGE_SUFFIXES):
+            raise ValueError(f"Upload name must be a plain file name ending in one of {', '.join(IMAGE_SUFFIXES)}")
+        path = self.upload_dir / name
+        tmp_path = path.with_name(f".{name}.{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as f:
+            remaining = length
+            while remaining > 0:
+                chunk = stream.read(min(remaining, 1 << 20))
+                if not chunk:
+                    raise ValueError("Upload ended before Content-Length bytes were received")
+                f.write(chunk)
+                remaining -= len(chunk)
+        os.replace(tmp_path, path)
+        return path
+
+    def submit(self, request):
+        """Validate a job request and queue it; raises ValueError for bad requests and queue.Full when busy."""
+        fixed = self.resolve_input(request["fixed"])
+        moving = self.resolve_input(request["moving"])
+        fixed_modality = request.get("fixed_modality", "ct")
+        moving_modality = request.get("moving_modality", fixed_modality)
+        if {fixed_modality, moving_modality} - {"ct", "mri"}:
+            raise ValueError("Modalities must be 'ct' or 'mri'")
+        io_iterations = int(request.get("io_iterations", 50))
+
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "fixed": str(fixed),
+            "moving": str(moving),
+            "fixed_modality": fixed_modality,
+            "moving_modality": moving_modality,
+            "io_iterations": io_iterations,
+            "submitted": time.time(),
+        }
+        with self.jobs_lock:
+            self.queue.put_nowait(job_id)
+            self.jobs[job_id] = job
+        return self.status(job_id)
+
+    def status(self, job_id):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            return {key: value for key, value in job.items() if key != "paths"} if job else None
+
+    def output_path(self, job_id, output):
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] != "done":
+                return None
+            return job["paths"][output]
+
+    def update(self, job_id, **fields):
+        with self.jobs_lock:
+            self.jobs[job_id].update(fields)
+
+    def worker(self):
+        while True:
+            job_id = self.queue.get()
+            with self.jobs_lock:
+                job = dict(self.jobs[job_id])
+            self.update(job_id, status="running", started=time.time())
+            try:
+                name = pair_name(job["fixed"], job["moving"])
+                job_dir = self.output_dir / job_id
+                job_dir.mkdir(parents=True, exist_ok=True)
+                paths = {
+                    "transform": job_dir / f"disp_{name}.hdf5",
+                    "warped": job_dir / f"warped_{name}.nii.gz",
+                    "disp": job_dir / f"disp_{name}.nii.gz",
+                }
+
+                pair = load_pair(job["fixed"], job["moving"], job["fixed_modality"], job["moving_modality"])
+                with self.network_lock:
+                    if self.network is None:
+                        self.network = get_network(self.io_sim, self.model)
+                    phi_AB = run_registration(self.network, pair, job["io_iterations"])
+                write_outputs(pair, phi_AB, paths["transform"], paths["warped"], paths["disp"])
+
+                self.update(job_id, status="done", finished=time.time(), paths=paths,
+                            outputs={output: f"/jobs/{job_id}/{output}" for output in OUTPUTS})
+                print(f"Job {job_id} done: {name}")
+            except Exception as e:
+                self.update(job_id, status="failed", finished=time.time(), error=str(e))
+                print(f"Job {job_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def health(self):
+        with self.jobs_lock:
+            running = sum(job["status"] == "running" for job in self.jobs.values())
+        return {
+            "status": "ok",
+            "model": self.model,
+            "model_loaded": self.network is not None,
+            "queued": self.queue.qsize(),
+            "running": running,
+        }
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Routes: GET /health, POST /jobs, PUT /uploads/<name>, GET /jobs/<id>, GET /jobs/<id>/<output>."""
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": message})
+
+    def content_length(self):
+        try:
+            return int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            return -1
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts == ["health"]:
+            self.send_json(HTTPStatus.OK, self.service.health())
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self.service.status(parts[1])
+            if job is None:
+                self.send_error_json(HTTPStatus.NOT_FOUND, f"Unknown job {parts[1]}")
+            else:
+                self.send_json(HTTPStatus.OK, job)
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] in OUTPUTS:
+            path = self.service.output_path(parts[1], parts[2])
+            if path is None:
+                self.send_error_json(HTTPStatus.NOT_FOUND, f"No finished job {parts[1]}")
+                return
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(path.stat().st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{path.name}"')
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+        else:
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        if self.path.split("?")[0].strip("/") != "jobs":
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"Unknown path {self.path}")
+            return
+        length = self.content_length()
+        if not 0 < length <= 1 << 16:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, "Expected a JSON body")
+            return
+        try:
+            job = self.service.submit(json.loads(self.rfile.read(length)))
+        except queue.Full:
+            self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE, "Job queue is full, retry later")
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, f"Invalid job: {e}")
+        else:
+            self.send_json(HTTPStatus.ACCEPTED, job)
+
+    def do_PUT(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "uploads":
+            self.send_error_json(HTTPStatus.NOT_FOUND, f"Unknown path {self.path}")
+            return
+        length = self.content_length()
+        if not 0 < length <= MAX_UPLOAD_SIZE:
+            self.send_error_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE if length > 0 else HTTPStatus.BAD_REQUEST,
+                                 f"Uploads must be between 1 byte and {MAX_UPLOAD_SIZE} bytes")
+            return
+        try:
+            path = self.service.save_upload(parts[1], self.rfile, length)
+        except ValueError as e:
+            self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+        else:
+            self.send_json(HTTPStatus.CREATED, {"path": path.name})
+
+    def log_message(self, format, *args):
+        if not self.path.startswith("/health"):
+            super().log_message(format, *args)
+
+def serve(host="0.0.0.0", port=5000, **service_args):
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = RegistrationService(**service_args)
+    print(f"Serving registration jobs on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP service that registers image pairs with a warm uniGradICON network.")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on.")
+    parser.add_argument("--input_root", default="input", help="Directory that job image paths are relative to.")
+    parser.add_argument("--output_dir", default="output/jobs", help="Directory for uploads and job outputs.")
+    parser.add_argument("--io_sim", default="lncc", choices=["lncc", "lncc2", "mind"], help="Similarity metric for IO.")
+    parser.add_argument("--model", default="unigradicon", choices=["unigradicon", "multigradicon"], help="Model to load.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker threads; loading and writing overlap the network.")
+    parser.add_argument("--max_queue", type=int, default=16, help="Queued jobs before requests are rejected with 503.")
+    args = parser.parse_args()
+
+    serve(
+        args.host, args.port, input_root=args.input_root, output_dir=args.output_dir,
+        io_sim=args.io_sim, model=args.model, workers=args.workers, max_queue=args.max_queue,
+    )
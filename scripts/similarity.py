@@ -0,0 +1,73 @@
+import numpy as np
+from scipy.ndimage import uniform_filter
+
+SIMILARITY_METRICS = ("NCC", "LNCC", "MI")
+
+def slabs(length, slab_size, halo=0):
+    """Yield (start, stop) of each slab along the first axis and its (lo, hi) extent including the halo."""
+    for start in range(0, length, slab_size):
+        stop = min(start + slab_size, length)
+        yield start, stop, max(start - halo, 0), min(stop + halo, length)
+
+def local_ncc(x, y, window, eps=1e-5):
+    """Local normalized cross-correlation map of two arrays over cubic box windows."""
+    mean_x = uniform_filter(x, window)
+    mean_y = uniform_filter(y, window)
+    var_x = np.maximum(uniform_filter(x * x, window) - mean_x ** 2, 0)
+    var_y = np.maximum(uniform_filter(y * y, window) - mean_y ** 2, 0)
+    cov = uniform_filter(x * y, window) - mean_x * mean_y
+    return cov / np.sqrt((var_x + eps) * (var_y + eps))
+
+def compute_similarity(fixed, warped, mask=None, metrics=SIMILARITY_METRICS, slab_size=16, window=9, bins=32):
+    """
+    Compute NCC, LNCC and mutual information of two volumes in a single pass over z-slabs.
+
+    Sums, sums of squares and cross products are accumulated in float64 so that only one
+    slab is ever copied. With a mask, every metric is restricted to the voxels where mask > 0.
+    LNCC slabs carry a halo of window // 2 slices, so the result equals a full-volume filter.
+    """
+    metrics = set(metrics)
+    halo = window // 2 if "LNCC" in metrics else 0
+    ranges = [(float(fixed.min()), float(fixed.max())), (float(warped.min()), float(warped.max()))]
+
+    # Shift by a reference value so that the float64 sums keep their precision
+    shift_x, shift_y = float(fixed[0].mean()), float(warped[0].mean())
+    sums = np.zeros(6)  # n, x, y, xx, yy, xy
+    lncc_sum = 0.0
+    joint_hist = np.zeros((bins, bins))
+
+    for start, stop, lo, hi in slabs(fixed.shape[0], slab_size, halo):
+        x = fixed[lo:hi].astype(np.float64)
+        y = warped[lo:hi].astype(np.float64)
+        core = slice(start - lo, stop - lo)
+        slab_mask = mask[start:stop] > 0 if mask is not None else np.ones(x[core].shape, dtype=bool)
+
+        x_core = x[core][slab_mask] - shift_x
+        y_core = y[core][slab_mask] - shift_y
+        sums += [x_core.size, x_core.sum(), y_core.sum(), x_core @ x_core, y_core @ y_core, x_core @ y_core]
+
+        if "MI" in metrics:
+            joint_hist += np.histogram2d(x_core + shift_x, y_core + shift_y, bins=bins, range=ranges)[0]
+        if "LNCC" in metrics:
+            lncc_sum += local_ncc(x, y, window)[core][slab_mask].sum()
+
+    n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = sums
+    results = {}
+    if "NCC" in metrics:
+        cov = sum_xy - sum_x * sum_y / n
+        var_x = sum_xx - sum_x ** 2 / n
+        var_y = sum_yy - sum_y ** 2 / n
+        results["NCC"] = float(cov / np.sqrt(var_x * var_y)) if var_x > 0 and var_y > 0 else 0.0
+    if "LNCC" in metrics:
+        results["LNCC"] = float(lncc_sum / n) if n > 0 else 0.0
+    if "MI" in metrics:
+        p_xy = joint_hist / joint_hist.sum()
+        p_x = p_xy.sum(axis=1, keepdims=True)
+        p_y = p_xy.sum(axis=0, keepdims=True)
+        nonzero = p_xy > 0
+        results["MI"] = float((p_xy[nonzero] * np.log(p_xy[nonzero] / (p_x @ p_y)[nonzero])).sum())
+    return results
+
+def compute_ncc(fixed, warped, mask=None, slab_size=16):
+    """Pearson correlation (NCC) of two volumes, optionally inside a mask, streamed over slabs."""
+    return compute_similarity(fixed, warped, mask=mask, metrics=("NCC",), slab_size=slab_size)["NCC"]
@@ -1,13 +1,18 @@
 import os
 import argparse
-import subprocess
 from datetime import datetime
-import torch
 import sys
 
-# Disable CUDA for macOS
+# Disable CUDA for macOS (before the network modules pick their device)
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
+import itk
+import numpy as np
+import SimpleITK as sitk
+
+from post_process import compute_metrics, load_image, report
+from registration import register_pair
+
 # Setup directories
 script_dir = os.path.dirname(os.path.abspath(__file__))
 base_dir = os.path.abspath(os.path.join(script_dir, ".."))
@@ -21,58 +26,48 @@ def generate_timestamped_filename(base_name, extension):
     timestamp = current_time.strftime("%d_%m_%Y_%H_%M")
     return f"{timestamp}_{base_name}{extension}"
 
-def main(fixed, moving, fixed_modality, moving_modality, io_iterations, io_sim):
-    # Ensure output directory exists
-    os.makedirs(os.path.join(base_dir, "outputs"), exist_ok=True)
-
-    # Generate output filenames
-    transform_out = generate_timestamped_filename("trans", ".hdf5")
-    warped_out = generate_timestamped_filename("warped_C01_1", ".nrrd")
+def main(fixed, moving, fixed_modality, moving_modality, io_iterations, io_sim, save=True, io_cache_dir=None):
+    fixed_path = os.path.join(base_dir, "data", fixed)
+    moving_path = os.path.join(base_dir, "data", moving)
 
-    # Registration command
-    venv_activate = os.path.join(base_dir, "unigradicon_venv/bin/activate")
-    registration_command = f"""
-    source {venv_activate} && unigradicon-register \
-        --fixed={os.path.join(base_dir, 'data', fixed)} \
-        --fixed_modality={fixed_modality} \
-        --moving={os.path.join(base_dir, 'data', moving)} \
-        --moving_modality={moving_modality} \
-        --transform_out={os.path.join(base_dir, 'outputs', transform_out)} \
-        --warped_moving_out={os.path.join(base_dir, 'outputs', warped_out)} \
-        --io_iterations={io_iterations} \
-        --io_sim={io_sim}
-    """
+    # Output filenames (only written with save=True)
+    transform_out = warped_out = None
+    if save:
+        os.makedirs(os.path.join(base_dir, "outputs"), exist_ok=True)
+        transform_out = os.path.join(base_dir, "outputs", generate_timestamped_filename("trans", ".hdf5"))
+        warped_out = os.path.join(base_dir, "outputs", generate_timestamped_filename("warped_C01_1", ".nrrd"))
 
-    print(f"Running registration command: {registration_command}")
+    # Registration in this process; the network stays loaded for further calls
+    print(f"Registering {moving_path} to {fixed_path}...")
     try:
-        subprocess.run(registration_command, shell=True, check=True, executable="/bin/bash", env={**os.environ, "CUDA_VISIBLE_DEVICES": "-1"})
+        _, warped = register_pair(
+            fixed_path, moving_path, modality=fixed_modality, moving_modality=moving_modality,
+            io_iterations=io_iterations, io_sim=io_sim,
+            transform_out=transform_out, warped_out=warped_out, io_cache_dir=io_cache_dir,
+        )
         print("Registration completed successfully!")
-    except subprocess.CalledProcessError as e:
+    except Exception as e:
         print(f"Error during registration: {e}")
         return
 
-    # Post-processing command
-    post_process_command = [
-        "python", os.path.join(base_dir, "scripts/post_process.py"),
-        f"--fixed={os.path.join(base_dir, 'data', fixed)}",
-        f"--warped={os.path.join(base_dir, 'outputs', warped_out)}"
-    ]
-
-    print(f"Running post-processing command: {' '.join(post_process_command)}")
-    try:
-        subprocess.run(post_process_command, check=True)
-        print("Post-processing completed successfully!")
-    except subprocess.CalledProcessError as e:
-        print(f"Error during post-processing: {e}")
+    # Post-processing on the in-memory images (the warped image is already on the fixed grid)
+    fixed_image = load_image(fixed_path)
+    fixed_np = sitk.GetArrayFromImage(fixed_image)
+    warped_np = np.asarray(itk.array_view_from_image(warped))
+    results = compute_metrics(fixed_np, warped_np, transform_out, spacing=fixed_image.GetSpacing()[::-1])
+    report(results, fixed_np, warped_np)
+    print("Post-processing completed successfully!")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Run unigradicon-register and post-process the results.")
+    parser = argparse.ArgumentParser(description="Register an image pair with uniGradICON and post-process the results.")
     parser.add_argument("--fixed", required=True, help="Path to the fixed image (.nrrd).")
     parser.add_argument("--moving", required=True, help="Path to the moving image (.nrrd).")
     parser.add_argument("--fixed_modality", required=True, choices=["mri", "ct"], help="Modality of the fixed image (e.g., mri, ct).")
     parser.add_argument("--moving_modality", required=True, choices=["mri", "ct"], help="Modality of the moving image (e.g., mri, ct).")
     parser.add_argument("--io_iterations", type=int, required=True, help="Number of IO iterations.")
     parser.add_argument("--io_sim", required=True, choices=["lncc", "lncc2", "mind"], help="Similarity metric for IO optimization.")
+    parser.add_argument("--no_save", action="store_true", help="Keep the transform and warped image in memory only.")
+    parser.add_argument("--io_cache_dir", help="Directory of cached IO states to warm-start from (e.g. output/cache/io).")
     args = parser.parse_args()
 
     main(
@@ -82,4 +77,6 @@ if __name__ == "__main__":
         moving_modality=args.moving_modality,
         io_iterations=args.io_iterations,
         io_sim=args.io_sim,
-    )
\ No newline at end of file
+        save=not args.no_save,
+        io_cache_dir=args.io_cache_dir,
+    )
@@ -1,12 +1,18 @@
 import os
-import random
+from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 
 from tqdm import tqdm
 import torch
-import torch.nn.functional as F
+import torch.distributed as dist
+from torch.utils.checkpoint import checkpoint
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from dataset import ThoraxCBCTDataset
-from torch.utils.data import DataLoader
+from augmentation import AugmentedDataset, augment
+from checkpoint import CheckpointManager, load_checkpoint, rng_state, set_rng_state
+from torch.utils.data import DataLoader, DistributedSampler
 
 import icon_registration as icon
 import icon_registration.networks as networks
@@ -24,6 +30,9 @@ elif torch.cuda.is_available():
 print(f"Using device: {device}")
 
 def write_stats(writer, stats: ICONLoss, ite, prefix=""):
+    # Only rank 0 has a writer when training with several processes
+    if writer is None:
+        return
     for k, v in to_floats(stats)._asdict().items():
         writer.add_scalar(f"{prefix}{k}", v, ite)
 
@@ -33,55 +42,130 @@ BATCH_SIZE = 4
 EXP_DIR = "./output/ucenje/"
 DATASET_DIR = "./input/Release_06_12_23"
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(SCRIPT_DIR, "../output/cache")
 
-def get_train_dataset():
+def get_train_dataset(preload=False, device=device):
     return ThoraxCBCTDataset(
         data_path=os.path.join(SCRIPT_DIR, f"../{DATASET_DIR}"),
         phase="train",
         desired_shape=input_shape[2:],
         device=device,
         paired=True,
+        cache_dir=CACHE_DIR,
+        preload=preload,
     )
 
-def get_val_dataset():
+def get_val_dataset(device=device):
     return ThoraxCBCTDataset(
         data_path=os.path.join(SCRIPT_DIR, f"../{DATASET_DIR}"),
         phase="val",
         desired_shape=input_shape[2:],
         device=device,
         paired=True,
+        cache_dir=CACHE_DIR,
     )
 
-def augment(image_A, image_B):
-    identity_list = []
-    for i in range(image_A.shape[0]):
-        identity = torch.zeros((1, 3, 4), device=image_A.device)
-        for j in range(3):
-            k = random.choice(range(3))
-            identity[0, j, k] = random.choice([-1, 1])
-        identity_list.append(identity)
-
-    identity = torch.cat(identity_list)
-    noise = torch.randn((image_A.shape[0], 3, 4), device=image_A.device)
-    forward = identity + 0.05 * noise
-
-    grid_shape = list(image_A.shape)
-    grid_shape[1] = 3
-    forward_grid = F.affine_grid(forward, grid_shape)
-
-    warped_A = F.grid_sample(image_A, forward_grid, padding_mode='border')
-    warped_B = F.grid_sample(image_B, forward_grid, padding_mode='border')
-
-    return warped_A, warped_B
-
-def train_kernel(optimizer, net, moving_image, fixed_image, writer, ite):
-    optimizer.zero_grad()
-    loss_object = net(moving_image, fixed_image)
-    loss = torch.mean(loss_object.all_loss)
-    loss.backward()
-    optimizer.step()
+def checkpoint_stages(net, num_stages):
+    """
+    Recompute the U-Net activations of num_stages displacement stages of net.regis_net during
+    backward instead of keeping them, starting with the full-resolution stages (-1: all).
+    Only forward is replaced, so the state_dict keys are unchanged.
+    """
+    stages = [m for m in net.regis_net.modules() if isinstance(m, icon.FunctionFromVectorField)]
+    stages.sort(key=lambda m: m.identity_map.numel(), reverse=True)
+    for stage in stages[:num_stages] if num_stages >= 0 else stages:
+        stage.net.forward = partial(checkpoint, type(stage.net).forward.__get__(stage.net), use_reentrant=False)
+    return net
+
+# Distributed training helpers
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+def setup_distributed(rank, world_size, backend="gloo"):
+    """Join the process group of world_size replicas and return the device of this rank."""
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    if device == "cuda":
+        torch.cuda.set_device(rank)
+        return f"cuda:{rank}"
+    # Share the cores between the replicas instead of oversubscribing them
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    return "cpu"
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+def wrap_network(net, rank_device):
+    """Wrap net in DistributedDataParallel when running with several processes."""
+    if not dist.is_initialized():
+        return net
+    return DistributedDataParallel(net, device_ids=[rank_device] if rank_device.startswith("cuda") else None)
+
+# Mixed precision: bfloat16 autocast on CPU, float16 with gradient scaling on CUDA
+def amp_dtype(device):
+    device_type = torch.device(device).type
+    if device_type == "cpu":
+        return torch.bfloat16
+    if device_type == "cuda":
+        return torch.float16
+    raise ValueError(f"Mixed precision training is not supported on {device}")
+
+def autocast(device, dtype=None):
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+def train_kernel(optimizer, net, moving_image, fixed_image, writer, ite, amp_dtype=None, scaler=None,
+                 window_size=1, step=True):
+    """
+    Accumulate the gradient of one micro-batch, averaged over an accumulation window of
+    window_size micro-batches, and step the optimizer on the last one (step=True).
+    """
+    # Gradients are only all-reduced across replicas on the micro-batch that steps
+    sync = nullcontext() if step or not isinstance(net, DistributedDataParallel) else net.no_sync()
+    with sync:
+        with autocast(moving_image.device, amp_dtype):
+            loss_object = net(moving_image, fixed_image)
+        loss = torch.mean(loss_object.all_loss) / window_size
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+    if step:
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
+        optimizer.zero_grad()
     write_stats(writer, loss_object, ite, prefix="train/")
 
+def validate(net, val_data_loader, device=device, amp_dtype=None, memory_format=torch.contiguous_format):
+    """Loss terms of net averaged over val_data_loader."""
+    net.eval()
+    totals, count = None, 0
+    with torch.no_grad():
+        for moving_image, fixed_image in val_data_loader:
+            moving_image = moving_image.to(device).contiguous(memory_format=memory_format)
+            fixed_image = fixed_image.to(device).contiguous(memory_format=memory_format)
+            with autocast(device, amp_dtype):
+                stats = to_floats(net(moving_image, fixed_image))
+            totals = stats if totals is None else type(stats)(*(t + v for t, v in zip(totals, stats)))
+            count += 1
+    net.clean()
+    net.train()
+    return type(totals)(*(t / count for t in totals))
+
+def gather_rng_states():
+    """RNG states of every replica, indexed by rank."""
+    if not dist.is_initialized():
+        return [rng_state()]
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, rng_state())
+    return states
+
 def train(
     net,
     optimizer,
@@ -93,65 +177,236 @@ def train(
     step_callback=(lambda net: None),
     unwrapped_net=None,
     data_augmenter=None,
+    device=device,
+    amp=False,
+    channels_last=False,
+    accumulation_steps=1,
+    checkpoint_manager=None,
+    resume_state=None,
+    seed=None,
 ):
+    """
+    Train for epochs, stepping the optimizer every accumulation_steps micro-batches (and on the
+    last micro-batch of an epoch, averaging over the shorter window).
+
+    Every eval_period epochs rank 0 logs the loss on val_data_loader; every save_period epochs
+    checkpoint_manager (rank 0 only) saves the network, optimizer and RNG states, with the
+    validation loss of that epoch if it was evaluated. resume_state, a saved checkpoint, continues
+    training after its epoch; replicas without a saved RNG state (resuming with a larger world
+    size) are reseeded with seed + rank instead.
+    """
     from torch.utils.tensorboard import SummaryWriter
 
     if unwrapped_net is None:
         unwrapped_net = net
 
-    writer = SummaryWriter(EXP_DIR + "/logs/" + datetime.now().strftime("%Y%m%d-%H%M%S"), flush_secs=30)
+    dtype = amp_dtype(device) if amp else None
+    scaler = torch.amp.GradScaler("cuda") if dtype == torch.float16 else None
+    memory_format = torch.channels_last_3d if channels_last else torch.contiguous_format
+
+    writer = None
+    if is_main_process():
+        writer = SummaryWriter(EXP_DIR + "/logs/" + datetime.now().strftime("%Y%m%d-%H%M%S"), flush_secs=30)
+
+    iteration, start_epoch = 0, 0
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state["optimizer"])
+        if scaler is not None and resume_state.get("scaler") is not None:
+            scaler.load_state_dict(resume_state["scaler"])
+        iteration, start_epoch = resume_state["iteration"], resume_state["epoch"] + 1
+        rank = dist.get_rank() if dist.is_initialized() else 0
+        if rank < len(resume_state["rng"]):
+            set_rng_state(resume_state["rng"][rank])
+        else:
+            print(f"Warning: the checkpoint has no RNG state for rank {rank} (saved with world size "
+                  f"{len(resume_state['rng'])}); data order and augmentation are not resumed exactly.")
+            if seed is not None:
+                torch.manual_seed(seed + rank)
+
+    num_batches = len(data_loader)
+    optimizer.zero_grad()
+    for epoch in tqdm(range(start_epoch, epochs), initial=start_epoch, total=epochs, disable=not is_main_process()):
+        # A different shuffle of every replica's shard in each epoch
+        if isinstance(data_loader.sampler, DistributedSampler):
+            data_loader.sampler.set_epoch(epoch)
+        for batch_index, (moving_image, fixed_image) in enumerate(data_loader):
+            window_start = batch_index - batch_index % accumulation_steps
+            window_size = min(accumulation_steps, num_batches - window_start)
+            step = batch_index + 1 == window_start + window_size
 
-    iteration = 0
-    for epoch in tqdm(range(epochs)):
-        for moving_image, fixed_image in data_loader:
             moving_image, fixed_image = moving_image.to(device), fixed_image.to(device)
             if data_augmenter is not None:
                 with torch.no_grad():
                     moving_image, fixed_image = data_augmenter(moving_image, fixed_image)
-            train_kernel(optimizer, net, moving_image, fixed_image, writer, iteration)
+            moving_image = moving_image.contiguous(memory_format=memory_format)
+            fixed_image = fixed_image.contiguous(memory_format=memory_format)
+            train_kernel(optimizer, net, moving_image, fixed_image, writer, iteration, dtype, scaler,
+                         window_size, step)
             iteration += 1
 
-            step_callback(unwrapped_net)
-
-def train_two_stage(input_shape, data_loader, val_data_loader, epochs, eval_period, save_period, resume_from):
-    net = make_network(input_shape, include_last_step=False)
-
+            if step:
+                step_callback(unwrapped_net)
+
+        val_loss = None
+        if eval_period > 0 and (epoch + 1) % eval_period == 0 and val_data_loader is not None and is_main_process():
+            val_stats = validate(unwrapped_net, val_data_loader, device, dtype, memory_format)
+            write_stats(writer, val_stats, iteration, prefix="val/")
+            val_loss = val_stats.all_loss
+
+        if save_period > 0 and (epoch + 1) % save_period == 0:
+            # Collective call, so every replica takes part even though only rank 0 saves
+            rng = gather_rng_states()
+            if checkpoint_manager is not None:
+                checkpoint_manager.save({
+                    "net": unwrapped_net.regis_net.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict() if scaler is not None else None,
+                    "rng": rng,
+                }, epoch, iteration, val_loss)
+
+    if checkpoint_manager is not None:
+        checkpoint_manager.wait()
+
+def train_two_stage(input_shape, data_loader, val_data_loader, epochs, eval_period, save_period, resume_from,
+                    data_augmenter=None, device=device, amp=False, channels_last=False, checkpointed_stages=0,
+                    accumulation_steps=1, keep_last=3, keep_best=3, seed=None):
+    """
+    Train the first stage, then the second stage initialized with its weights.
+
+    Under torch.distributed every process trains a DistributedDataParallel replica on its
+    shard of the data; only rank 0 writes logs and checkpoints. amp enables mixed precision
+    and channels_last the channels_last_3d memory format for the network and its inputs.
+    checkpointed_stages trades compute for memory, see checkpoint_stages. Every optimizer step
+    accumulates the gradients of accumulation_steps micro-batches.
+
+    resume_from is either a checkpoint of CheckpointManager, resumed exactly in its stage, or
+    a regis_net state dict of the first stage. Rank 0 keeps the last keep_last and the best
+    keep_best checkpoints of each stage.
+    """
+    memory_format = torch.channels_last_3d if channels_last else torch.contiguous_format
+
+    def checkpoint_manager(name):
+        return CheckpointManager(EXP_DIR + "checkpoints", name, keep_last, keep_best) if is_main_process() else None
+
+    resume_state, initial_weights = None, None
     if resume_from:
         print("Resume from:", resume_from)
-        net.regis_net.load_state_dict(torch.load(resume_from, map_location="cpu"))
-
-    net = net.to(device)
-    optimizer = torch.optim.Adam(net.parameters(), lr=0.00005)
-
-    print("Start training.")
-    train(net, optimizer, data_loader, val_data_loader, epochs[0], eval_period, save_period)
-
-    torch.save(net.regis_net.state_dict(), EXP_DIR + "checkpoints/Step_1_final.trch")
+        resume_state = load_checkpoint(resume_from)
+        if "net" not in resume_state:
+            # Plain regis_net weights
+            resume_state, initial_weights = None, resume_state
+    train_kwargs = dict(data_augmenter=data_augmenter, device=device, amp=amp, channels_last=channels_last,
+                        accumulation_steps=accumulation_steps, seed=seed)
+
+    if resume_state is None or resume_state["name"] == "Step_1":
+        net = make_network(input_shape, include_last_step=False)
+        checkpoint_stages(net, checkpointed_stages)
+        if resume_state is not None:
+            net.regis_net.load_state_dict(resume_state["net"])
+        elif initial_weights is not None:
+            net.regis_net.load_state_dict(initial_weights)
+
+        net = net.to(device, memory_format=memory_format)
+        net_par = wrap_network(net, device)
+        optimizer = torch.optim.Adam(net_par.parameters(), lr=0.00005)
+
+        print("Start training.")
+        train(net_par, optimizer, data_loader, val_data_loader, epochs[0], eval_period, save_period,
+              unwrapped_net=net, checkpoint_manager=checkpoint_manager("Step_1"), resume_state=resume_state,
+              **train_kwargs)
+        resume_state = None
+
+        if is_main_process():
+            torch.save(net.regis_net.state_dict(), EXP_DIR + "checkpoints/Step_1_final.trch")
+        # The replicas hold identical weights; wait for the checkpoint before moving on together
+        barrier()
 
     net_2 = make_network(input_shape, include_last_step=True)
-    net_2.regis_net.netPhi.load_state_dict(net.regis_net.state_dict())
-
-    del net
-    optimizer = torch.optim.Adam(net_2.parameters(), lr=0.00005)
-    net_2 = net_2.to(device)
+    checkpoint_stages(net_2, checkpointed_stages)
+    if resume_state is not None:
+        net_2.regis_net.load_state_dict(resume_state["net"])
+    else:
+        net_2.regis_net.netPhi.load_state_dict(net.regis_net.state_dict())
+        del net, net_par
+
+    net_2 = net_2.to(device, memory_format=memory_format)
+    net_2_par = wrap_network(net_2, device)
+    optimizer = torch.optim.Adam(net_2_par.parameters(), lr=0.00005)
+
+    train(net_2_par, optimizer, data_loader, val_data_loader, epochs[1], eval_period, save_period,
+          unwrapped_net=net_2, checkpoint_manager=checkpoint_manager("Step_2"), resume_state=resume_state,
+          **train_kwargs)
+    if is_main_process():
+        torch.save(net_2.regis_net.state_dict(), EXP_DIR + "checkpoints/Step_2_final.trch")
+    barrier()
+
+def main(rank, world_size, args):
+    """Train on one process; with world_size > 1 this is one DistributedDataParallel replica."""
+    rank_device = setup_distributed(rank, world_size, args.backend) if world_size > 1 else device
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed + rank)
+
+    if is_main_process():
+        os.makedirs(EXP_DIR + "checkpoints", exist_ok=True)
+
+    train_dataset = get_train_dataset(preload=args.preload, device=rank_device)
+    val_dataset = get_val_dataset(device=rank_device)
+
+    if args.augment == "workers":
+        train_dataset = AugmentedDataset(train_dataset)
+    data_augmenter = augment if args.augment == "main" else None
+
+    # Each replica draws BATCH_SIZE pairs per micro-batch from its own shard; by default every
+    # micro-batch steps the optimizer, i.e. no accumulation
+    effective_batch_size = args.effective_batch_size
+    if effective_batch_size is None:
+        effective_batch_size = BATCH_SIZE * world_size
+    elif effective_batch_size <= 0 or effective_batch_size % (BATCH_SIZE * world_size):
+        raise ValueError(f"--effective_batch_size must be a multiple of {BATCH_SIZE * world_size} "
+                         f"(BATCH_SIZE x world_size)")
+    accumulation_steps = effective_batch_size // (BATCH_SIZE * world_size)
+    sampler = DistributedSampler(train_dataset, drop_last=True, seed=args.seed or 0) if world_size > 1 else None
+    train_dataloader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=sampler is None, sampler=sampler,
+                                  num_workers=4, drop_last=True)
+    val_dataloader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4, drop_last=True)
 
-    train(net_2, optimizer, data_loader, val_data_loader, epochs[1], eval_period, save_period)
-    torch.save(net_2.regis_net.state_dict(), EXP_DIR + "checkpoints/Step_2_final.trch")
+    try:
+        train_two_stage(input_shape, train_dataloader, val_dataloader, [801, 201], 20, 20, args.resume_from,
+                        data_augmenter=data_augmenter, device=rank_device, amp=args.amp,
+                        channels_last=args.channels_last, checkpointed_stages=args.checkpoint_stages,
+                        accumulation_steps=accumulation_steps, keep_last=args.keep_last,
+                        keep_best=args.keep_best, seed=args.seed)
+    finally:
+        if dist.is_initialized():
+            dist.destroy_process_group()
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--resume_from", required=False, default="")
+    parser.add_argument("--resume_from", required=False, default="",
+                        help="Checkpoint to resume exactly, or regis_net weights of the first stage.")
+    parser.add_argument("--preload", action="store_true", help="Keep all training volumes in shared memory.")
+    parser.add_argument("--augment", choices=["none", "main", "workers"], default="none",
+                        help="Apply augmentation on the main process or inside the DataLoader workers.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible data order and augmentation.")
+    parser.add_argument("--world_size", type=int, default=1, help="Number of DistributedDataParallel processes.")
+    parser.add_argument("--backend", default="gloo", help="torch.distributed backend (gloo also runs on CPU only).")
+    parser.add_argument("--amp", action="store_true",
+                        help="Mixed precision: bfloat16 autocast on CPU, float16 with gradient scaling on CUDA.")
+    parser.add_argument("--channels_last", action="store_true", help="Use the channels_last_3d memory format.")
+    parser.add_argument("--checkpoint_stages", type=int, default=0,
+                        help="Recompute activations of this many stages in backward, full resolution first (-1: all).")
+    parser.add_argument("--effective_batch_size", type=int, default=None,
+                        help="Pairs per optimizer step over all replicas, reached by gradient accumulation "
+                             "(default: BATCH_SIZE x world_size, no accumulation).")
+    parser.add_argument("--keep_last", type=int, default=3, help="Number of most recent checkpoints kept per stage.")
+    parser.add_argument("--keep_best", type=int, default=3,
+                        help="Number of checkpoints with the lowest validation loss kept per stage.")
     args = parser.parse_args()
-    resume_from = args.resume_from
-
-    os.makedirs(EXP_DIR + "checkpoints", exist_ok=True)
-
-    train_dataset = get_train_dataset()
-    val_dataset = get_val_dataset()
-
-    train_dataloader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=4, drop_last=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4, drop_last=True)
 
-    train_two_stage(input_shape, train_dataloader, val_dataloader, [801, 201], 20, 20, resume_from)
\ No newline at end of file
+    if args.world_size > 1:
+        mp.spawn(main, args=(args.world_size, args), nprocs=args.world_size)
+    else:
+        main(0, 1, args)
\ No newline at end of file
@@ -0,0 +1,128 @@
+import h5py
+import numpy as np
+from scipy.ndimage import map_coordinates
+
+AFFINE_TRANSFORMS = (
+    "AffineTransform",
+    "CenteredAffineTransform",
+    "MatrixOffsetTransformBase",
+    "TranslationTransform",
+)
+
+# Readers for ITK transforms stored in HDF5 (.hdf5/.h5) files
+def read_transform_type(group):
+    """Read the TransformType string of an HDF5 transform group."""
+    return group["TransformType"][()][0].decode()
+
+def read_affine(group):
+    """
+    Read an affine-like transform from an HDF5 transform group as a single 4x4 matrix.
+
+    ITK maps x to A (x - c) + c + t, which is folded here into one homogeneous matrix.
+    """
+    transform_type = read_transform_type(group).split("_")[0]
+    params = np.asarray(group["TransformParameters"][:], dtype=np.float64)
+    fixed_params = np.asarray(group["TransformFixedParameters"][:], dtype=np.float64)
+
+    if transform_type == "TranslationTransform":
+        matrix, translation, center = np.eye(3), params, np.zeros(3)
+    elif transform_type == "CenteredAffineTransform":
+        # Parameters are matrix (9), center (3), translation (3)
+        matrix, center, translation = params[:9].reshape(3, 3), params[9:12], params[12:15]
+    elif len(params) == 12:
+        matrix, translation = params[:9].reshape(3, 3), params[9:]
+        center = fixed_params if len(fixed_params) == 3 else np.zeros(3)
+    else:
+        raise ValueError(f"Unexpected affine parameter length: {len(params)}")
+
+    affine = np.eye(4)
+    affine[:3, :3] = matrix
+    affine[:3, 3] = translation + center - matrix @ center
+    return affine
+
+def read_displacement_field(group):
+    """
+    Read a DisplacementFieldTransform and its grid geometry from an HDF5 transform group.
+
+    ITK stores the grid in TransformFixedParameters as size (3), origin (3), spacing (3)
+    and a row-major direction matrix (9). The field itself is flattened with x running
+    fastest, so it is returned as a (3, z, y, x) array of physical displacements.
+    """
+    fixed_params = np.asarray(group["TransformFixedParameters"][:], dtype=np.float64)
+    size = fixed_params[:3].astype(int)
+    origin = fixed_params[3:6]
+    spacing = fixed_params[6:9]
+    direction = fixed_params[9:18].reshape(3, 3)
+
+    field = np.asarray(group["TransformParameters"][:], dtype=np.float64)
+    field = field.reshape(size[2], size[1], size[0], 3)
+    field = np.ascontiguousarray(np.moveaxis(field, -1, 0))
+    return field, origin, spacing, direction
+
+# Point warping
+def physical_to_index(points, origin, spacing, direction):
+    """Convert (N, 3) physical points to continuous (x, y, z) voxel indices."""
+    return (points - origin) @ np.linalg.inv(direction * spacing).T
+
+def sample_displacement(field, index):
+    """
+    Trilinearly sample a (3, z, y, x) displacement field at (N, 3) continuous indices.
+
+    Points outside the field's buffer get zero displacement, as in ITK.
+    """
+    size = np.array(field.shape[:0:-1])
+    inside = np.all((index >= -0.5) & (index <= size - 0.5), axis=1)
+    coords = index[:, ::-1].T  # map_coordinates expects (z, y, x) order
+    displacement = np.stack(
+        [map_coordinates(component, coords, order=1, mode="nearest") for component in field], axis=1
+    )
+    displacement[~inside] = 0
+    return displacement
+
+def warp_points_displacement(points, field, origin, spacing, direction):
+    """Apply a displacement field transform to (N, 3) physical points in one pass."""
+    points = np.asarray(points, dtype=np.float64)
+    index = physical_to_index(points, origin, spacing, direction)
+    return points + sample_displacement(field, index)
+
+# Transform chains
+def read_transform_chain(transform_file):
+    """
+    Read every transform in an HDF5 transform file as an ordered chain of steps.
+
+    A CompositeTransform stores its sub-transforms in the following groups, and ITK applies
+    them from the last one to the first. Files without a composite are applied in file
+    order. Each step is ("affine", 4x4 matrix) or ("field", field, origin, spacing, direction),
+    and consecutive affines are folded into a single matrix.
+    """
+    with h5py.File(transform_file, "r") as f:
+        groups = [f["TransformGroup"][key] for key in sorted(f["TransformGroup"].keys(), key=int)]
+        if read_transform_type(groups[0]).startswith("CompositeTransform"):
+            groups = groups[1:][::-1]
+
+        chain = []
+        for group in groups:
+            transform_type = read_transform_type(group)
+            if transform_type.startswith(AFFINE_TRANSFORMS):
+                affine = read_affine(group)
+                if chain and chain[-1][0] == "affine":
+                    affine = affine @ chain.pop()[1]
+                chain.append(("affine", affine))
+            elif transform_type.startswith("DisplacementFieldTransform"):
+                chain.append(("field", *read_displacement_field(group)))
+            elif transform_type.startswith("IdentityTransform"):
+                continue
+            else:
+                raise ValueError(f"Unsupported TransformType: {transform_type}")
+    return chain
+
+def apply_transform_chain(points, chain):
+    """Apply a transform chain to (N, 3) physical points, one batched pass per step."""
+    points = np.asarray(points, dtype=np.float64)
+    for kind, *params in chain:
+        if kind == "affine":
+            affine = params[0]
+            points = points @ affine[:3, :3].T + affine[:3, 3]
+        else:
+            points = warp_points_displacement(points, *params)
+    return points
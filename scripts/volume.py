@@ -0,0 +1,120 @@
+from pathlib import Path
+
+import h5py
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+class Volume:
+    """
+    Image on disk whose header is read on construction and whose voxels are read on demand.
+
+    shape is (z, y, x) like the arrays returned by read(); size, spacing, origin and direction
+    follow SimpleITK (x, y, z) conventions. read() and read_image() take an optional ROI of
+    (z, y, x) slices and decode only that region where the format allows it:
+    - HDF5 (warped_image dataset): h5py slicing, reading only the chunks it touches
+    - NIfTI: nibabel's array proxy, memory-mapped for uncompressed .nii
+    - other formats (NRRD, MetaImage, ...): SimpleITK ImageFileReader with an extract region
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        suffixes = Path(self.path).suffixes
+        if suffixes[-1:] == [".hdf5"]:
+            self.format = "hdf5"
+            with h5py.File(self.path, "r") as f:
+                if "warped_image" not in f:
+                    raise ValueError("Missing 'warped_image' in HDF5 file.")
+                self.shape = tuple(f["warped_image"].shape)
+            self.spacing, self.origin, self.direction = (1.0, 1.0, 1.0), (0.0, 0.0, 0.0), tuple(np.eye(3).ravel())
+        else:
+            self.format = "nifti" if suffixes[-1:] == [".nii"] or suffixes[-2:] == [".nii", ".gz"] else "sitk"
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(self.path)
+            reader.ReadImageInformation()
+            self.shape = tuple(reader.GetSize()[::-1])
+            self.spacing, self.origin, self.direction = reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection()
+
+    @property
+    def size(self):
+        return self.shape[::-1]
+
+    def clip_roi(self, roi=None):
+        """ROI as (z, y, x) slices with explicit bounds inside the volume (the whole volume if None)."""
+        if roi is None:
+            return tuple(slice(0, n) for n in self.shape)
+        return tuple(slice(*s.indices(n)[:2]) for s, n in zip(roi, self.shape))
+
+    def read(self, roi=None):
+        """Voxels of the ROI as a (z, y, x) array."""
+        roi = self.clip_roi(roi)
+        if self.format == "hdf5":
+            with h5py.File(self.path, "r") as f:
+                return f["warped_image"][roi]
+        if self.format == "nifti":
+            image = nib.load(self.path, mmap=True)
+            array = np.asarray(image.dataobj[roi[2], roi[1], roi[0]]).T
+            # Scaled NIfTI data comes back as float64, SimpleITK reads it as float32
+            return array.astype(np.float32) if array.dtype == np.float64 else array
+
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.path)
+        reader.SetExtractIndex([s.start for s in roi[::-1]])
+        reader.SetExtractSize([s.stop - s.start for s in roi[::-1]])
+        return sitk.GetArrayFromImage(reader.Execute())
+
+    def read_image(self, roi=None):
+        """ROI as a SimpleITK image with the physical geometry of that region."""
+        roi = self.clip_roi(roi)
+        image = sitk.GetImageFromArray(self.read(roi))
+        image.SetSpacing(self.spacing)
+        image.SetDirection(self.direction)
+        image.SetOrigin(self.index_to_physical([s.start for s in roi[::-1]]))
+        return image
+
+    def index_to_physical(self, index):
+        """Physical point of a continuous (x, y, z) index."""
+        matrix = np.reshape(self.direction, (3, 3)) * self.spacing
+        return tuple(np.asarray(self.origin) + matrix @ np.asarray(index, dtype=np.float64))
+
+    def physical_to_index(self, points):
+        """Continuous (x, y, z) indices of (N, 3) physical points."""
+        matrix = np.reshape(self.direction, (3, 3)) * self.spacing
+        return (np.asarray(points, dtype=np.float64) - self.origin) @ np.linalg.inv(matrix).T
+
+    def roi_covering(self, other, other_roi=None, margin=1):
+        """ROI of this volume that covers the physical extent of other_roi in another volume (for resampling)."""
+        other_roi = other.clip_roi(other_roi)
+        bounds = [(s.start - 0.5, s.stop - 0.5) for s in other_roi[::-1]]
+        corners = np.array(np.meshgrid(*bounds, indexing="ij")).reshape(3, -1).T
+        index = self.physical_to_index([other.index_to_physical(corner) for corner in corners])
+        lower = np.floor(index.min(0)).astype(int) - margin
+        upper = np.ceil(index.max(0)).astype(int) + 1 + margin
+        roi = []
+        for lo, hi, n in zip(lower[::-1], upper[::-1], self.shape):
+            lo, hi = min(max(lo, 0), n - 1), min(max(hi, 1), n)
+            roi.append(slice(lo, max(hi, lo + 1)))
+        return tuple(roi)
+
+def mask_bounding_box(volume, margin=0, slab_size=32):
+    """Bounding box (z, y, x slices) of the nonzero voxels of a label map, read slab by slab; None if empty."""
+    lower, upper = None, None
+    for start in range(0, volume.shape[0], slab_size):
+        slab = volume.read((slice(start, start + slab_size), slice(None), slice(None))) != 0
+        if not slab.any():
+            continue
+        nonzero = [np.flatnonzero(slab.any(axis=tuple(a for a in range(3) if a != axis))) for axis in range(3)]
+        slab_lower = np.array([start + nonzero[0][0], nonzero[1][0], nonzero[2][0]])
+        slab_upper = np.array([start + nonzero[0][-1], nonzero[1][-1], nonzero[2][-1]]) + 1
+        lower = slab_lower if lower is None else np.minimum(lower, slab_lower)
+        upper = slab_upper if upper is None else np.maximum(upper, slab_upper)
+    if lower is None:
+        return None
+    return tuple(slice(int(max(lo - margin, 0)), int(min(hi + margin, n))) for lo, hi, n in zip(lower, upper, volume.shape))
+
+def parse_roi(text):
+    """Parse a 'z0:z1,y0:y1,x0:x1' ROI (empty bounds allowed) into slices."""
+    parts = text.split(",")
+    if len(parts) != 3:
+        raise ValueError(f"ROI must have three comma-separated ranges (z, y, x): {text}")
+    return tuple(slice(*(int(v) if v else None for v in part.split(":"))) for part in parts)
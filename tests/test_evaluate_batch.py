@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+pytest.importorskip("SimpleITK")
+from evaluate_batch import aggregate
+
+def test_aggregate_leaves_out_non_finite_values():
+    aggregates = aggregate({
+        "a": {"HD95": 1.0, "DSC": "N/A"},
+        "b": {"HD95": float("inf"), "DSC": 0.5},
+        "c": {"HD95": 3.0},
+    })
+    assert aggregates["HD95"] == {"mean": 2.0, "std": 1.0, "30": pytest.approx(1.6), "non_finite": 1}
+    assert aggregates["DSC"]["mean"] == 0.5 and aggregates["DSC"]["non_finite"] == 0
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from oncoreg import annotation_index, find_pair_annotations
+
+def make_dataset(root):
+    """ThoraxCBCT-like layout: case 0011 with two pairs, each with its own keypoints folder."""
+    (root / "imagesTr").mkdir()
+    for timepoint in ("0000", "0001", "0002"):
+        (root / "imagesTr" / f"ThoraxCBCT_0011_{timepoint}.nii.gz").touch()
+    for index, timepoint in ((1, "0001"), (2, "0002")):
+        folder = root / f"keypoints{index:02d}Tr"
+        folder.mkdir()
+        for name in ("0000", timepoint):
+            (folder / f"ThoraxCBCT_0011_{name}.csv").write_text(f"{index}\n")
+    pairs = [
+        {"fixed": f"./imagesTr/ThoraxCBCT_0011_{timepoint}.nii.gz", "moving": "./imagesTr/ThoraxCBCT_0011_0000.nii.gz"}
+        for timepoint in ("0001", "0002")
+    ]
+    (root / "ThoraxCBCT_dataset.json").write_text(json.dumps({"registration_val": pairs}))
+    return pairs
+
+def test_pair_annotations_come_from_one_folder(tmp_path):
+    make_dataset(tmp_path)
+    image = lambda timepoint: str(tmp_path / "imagesTr" / f"ThoraxCBCT_0011_{timepoint}.nii.gz")
+
+    assert annotation_index(image("0002"), image("0000")) == 2
+    assert annotation_index(image("0000"), image("0001")) == 1
+
+    for timepoint, folder in (("0001", "keypoints01Tr"), ("0002", "keypoints02Tr")):
+        fixed_csv, moving_csv = find_pair_annotations(image(timepoint), image("0000"), "keypoints")
+        assert fixed_csv == str(tmp_path / folder / f"ThoraxCBCT_0011_{timepoint}.csv")
+        assert moving_csv == str(tmp_path / folder / "ThoraxCBCT_0011_0000.csv")
+
+    assert find_pair_annotations(image("0002"), image("0000"), "landmarks") == (None, None)
+
+def test_discover_cases_uses_the_pair_folder(tmp_path):
+    pytest.importorskip("SimpleITK")
+    from evaluate_batch import discover_cases
+
+    make_dataset(tmp_path)
+    results_dir = tmp_path / "output"
+    results_dir.mkdir()
+    for name in ("0011_0001_0011_0000", "0011_0002_0011_0000"):
+        (results_dir / f"warped_{name}.nii.gz").touch()
+        (results_dir / f"disp_{name}.hdf5").touch()
+
+    cases = discover_cases(str(tmp_path), str(results_dir), "val")
+    assert [case["name"] for case in cases] == ["0011_0001<--0011_0000", "0011_0002<--0011_0000"]
+    for case, folder in zip(cases, ("keypoints01Tr", "keypoints02Tr")):
+        folders = {os.path.dirname(os.path.normpath(case[key])) for key in ("kp_fixed", "kp_moving")}
+        assert folders == {str(tmp_path / folder)}